@@ -0,0 +1,178 @@
+# Xylem: Convert Python Abstract Syntax Trees to readable source code
+# Copyright (C) 2018 Ariel Antonitis. Licensed under the MIT license.
+#
+# bench.py
+""" Benchmarks the throughput, latency and memory use of rendering and comparing ASTs.
+
+Run python3 bench.py to benchmark the local standard library, synthetic worst cases and every type of node, optionally
+saving the results as JSON with -o. Pass a previous results file with --compare to print how each benchmark changed.
+"""
+import os
+import ast
+import sys
+import copy
+import json
+import time
+import argparse
+import platform
+import sysconfig
+import tracemalloc
+
+import xylem
+from xylem import to_source, compare_ast
+
+sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))  # copy.deepcopy is recursive
+
+# Snippets exercising each type of node, repeated to make a module for the micro-benchmarks
+micro = {'Name': 'a', 'Constant': "1; 'a'; b'a'; 1.5; None; ...", 'JoinedStr': "f'{a!r} and {b:>{c}}'",
+         'List': '[a, b, c]', 'Tuple': '(a, b, c)', 'Set': '{a, b, c}', 'Dict': '{a: b, **c}',
+         'UnaryOp': '-a; not b', 'BinOp': 'a + b*c - d//e', 'BoolOp': 'a and b or c', 'Compare': 'a < b <= c != d',
+         'Call': 'a(b, *c, d=e, **f)', 'IfExp': 'a if b else c', 'Attribute': 'a.b.c', 'Subscript': 'a[b]; a[b:c:d]',
+         'ListComp': '[a for b in c if d]', 'DictComp': '{a: b for a, b in c}', 'GeneratorExp': '(a for b in c)',
+         'Lambda': 'lambda a, b=1, *c, d, **e: a', 'Assign': 'a = b = c', 'AugAssign': 'a += b',
+         'AnnAssign': 'a: int = b', 'Import': 'import a.b as c; from . import d', 'Raise': 'raise a from b',
+         'Assert': 'assert a, b', 'Delete': 'del a, b', 'If': 'if a:\n    b\nelif c:\n    d\nelse:\n    e',
+         'For': 'for a in b:\n    c\nelse:\n    d', 'While': 'while a:\n    break',
+         'Try': 'try:\n    a\nexcept b as c:\n    d\nelse:\n    e\nfinally:\n    f', 'With': 'with a as b, c:\n    d',
+         'FunctionDef': '@a\ndef b(c: d, *, e=f) -> g:\n    return c', 'ClassDef': 'class a(b, metaclass=c):\n    pass',
+         'AsyncFunctionDef': 'async def a():\n    await b\n    async for c in d:\n        yield c'}
+
+
+def stdlib():  # Yields the name and source of every module in the local standard library that xylem can render
+    root = sysconfig.get_paths()['stdlib']
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in ('site-packages', 'test', 'tests', '__pycache__'))
+        for name in sorted(files):
+            if name.endswith('.py'):
+                path = os.path.join(directory, name)
+                try:
+                    with open(path, 'rb') as f:
+                        source = f.read()
+                    to_source(ast.parse(source))
+                except Exception:
+                    continue
+                yield os.path.relpath(path, root), source
+
+
+def synthetic(size):  # Yields the name and tree of worst cases for rendering
+    node = ast.Name(id='a', ctx=ast.Load())
+    for i in range(size):
+        node = ast.BinOp(left=node, op=ast.Add(), right=ast.Name(id='b', ctx=ast.Load()))
+    yield 'BinOp chain', ast.Expression(body=node)
+    values = [ast.Name(id='a', ctx=ast.Load())] * size
+    yield 'BoolOp chain', ast.Expression(body=ast.BoolOp(op=ast.And(), values=values))
+    tree = ast.Module(body=[], type_ignores=[])
+    body = tree.body
+    for i in range(size // 10):
+        node = ast.If(test=ast.Name(id='a', ctx=ast.Load()), body=[], orelse=[])
+        body.append(node)
+        body = node.body
+    body.append(ast.Pass())
+    yield 'nested If', tree
+    yield 'nested calls', ast.parse('a(' * (size // 10) + ')' * (size // 10), mode='eval')
+    yield 'huge list', ast.parse('[' + ', '.join(map(str, range(size * 10))) + ']', mode='eval')
+    yield 'huge dict', ast.parse('{' + ', '.join('%d: "%d"' % (i, i) for i in range(size * 5)) + '}', mode='eval')
+
+
+def count(tree):
+    return sum(1 for _ in ast.walk(tree))
+
+
+def best(func, repeat):  # The fastest of several timed calls, and the result of the last
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def measure(tree, repeat):
+    """ Benchmarks rendering a tree with to_source (and ast.unparse, where available), and comparing it with a copy.
+
+    Args:
+        tree: The AST to benchmark.
+        repeat (int): The number of times each operation is timed.
+
+    Returns: dict: The number of nodes, source bytes, seconds, nodes/sec, bytes/sec and peak memory for each operation.
+    """
+    nodes = count(tree)
+    seconds, source = best(lambda: to_source(tree), repeat)
+    size = len(source.encode('utf-8'))
+    tracemalloc.start()
+    to_source(tree)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {'nodes': nodes, 'bytes': size, 'seconds': seconds, 'nodes/sec': nodes / seconds,
+              'bytes/sec': size / seconds, 'peak memory': peak}
+    other = copy.deepcopy(tree)
+    seconds = best(lambda: compare_ast(tree, other), repeat)[0]
+    result['compare_ast'] = {'seconds': seconds, 'nodes/sec': nodes / seconds}
+    if hasattr(ast, 'unparse'):  # Python 3.9+
+        try:
+            seconds, source = best(lambda: ast.unparse(tree), repeat)
+        except (RecursionError, ValueError):  # Trees too deep to unparse
+            result['ast.unparse'] = None
+        else:
+            result['ast.unparse'] = {'seconds': seconds, 'bytes/sec': len(source.encode('utf-8')) / seconds,
+                                     'relative': result['seconds'] / seconds}
+    return result
+
+
+def run(args):
+    results = {'python': platform.python_version(), 'xylem': xylem.__version__, 'corpus': {}, 'synthetic': {},
+               'micro': {}}
+    if not args.no_stdlib:
+        modules = list(stdlib())[:args.limit]
+        trees = [ast.parse(source) for name, source in modules]
+        for (name, source), tree in zip(modules, trees):
+            if args.each:
+                results['corpus'][name] = measure(tree, args.repeat)
+        module = ast.Module(body=[statement for tree in trees for statement in tree.body], type_ignores=[])
+        results['corpus']['total'] = total = measure(module, args.repeat)
+        print('stdlib: {} modules, {nodes} nodes, {nodes/sec:.0f} nodes/s, {bytes/sec:.0f} bytes/s'.format(
+            len(trees), **total), file=sys.stderr)
+    for name, tree in synthetic(args.size):
+        results['synthetic'][name] = measure(tree, args.repeat)
+    for name, source in sorted(micro.items()):
+        results['micro'][name] = measure(ast.parse('\n'.join([source] * args.size)), args.repeat)
+    return results
+
+
+def report(results, previous=None):
+    # The time relative to ast.unparse, and the change in speed since the previous run
+    print('{:<40} {:>10} {:>14} {:>12} {:>10} {:>10}'.format('benchmark', 'nodes', 'nodes/s', 'peak KiB', 'unparse',
+                                                             'change'))
+    for suite in ('corpus', 'synthetic', 'micro'):
+        for name, result in results[suite].items():
+            unparse = result.get('ast.unparse')
+            old = (previous or {}).get(suite, {}).get(name)
+            print('{:<40} {:>10} {:>14.0f} {:>12.1f} {:>10} {:>10}'.format(
+                (suite + ': ' + name)[:40], result['nodes'], result['nodes/sec'], result['peak memory'] / 1024,
+                '{:.2f}x'.format(unparse['relative']) if unparse else '-',
+                '{:+.1%}'.format(old['seconds'] / result['seconds'] - 1) if old else '-'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark rendering and comparing ASTs with xylem.')
+    parser.add_argument('-o', '--output', metavar='FILE', help='save the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare the speed of each benchmark with a previous run')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='number of times to time each benchmark')
+    parser.add_argument('--size', type=int, default=1000, help='size of the synthetic and micro benchmarks')
+    parser.add_argument('--limit', type=int, help='only benchmark the first LIMIT standard library modules')
+    parser.add_argument('--each', action='store_true', help='benchmark each standard library module separately')
+    parser.add_argument('--no-stdlib', action='store_true', help="don't benchmark the standard library")
+    args = parser.parse_args(argv)
+    results = run(args)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report(results, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,7 @@ setup(name='xylem',
       author_email='arant@mit.edu',
       url=url,
       py_modules=['xylem'],
+      entry_points={'console_scripts': ['xylem = xylem:main']},
       package_data={'*': ['README.rst', 'test.py']},
       license='MIT',
       classifiers=['License :: OSI Approved :: MIT License',
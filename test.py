@@ -1,9 +1,25 @@
+import io
+import os
+import time
 import ast
 import sys
+import tempfile
+import threading
+import subprocess
 import inspect
+import marshal
+import mmap
+import socket
+import asyncio
+import pickle
 import unittest
+import contextlib
+from unittest import mock
+from concurrent import futures
 
-from xylem import to_source, compare_ast, max_depth
+from xylem import to_source, to_source_stream, to_source_to_file, to_source_async, to_source_into, to_source_many, \
+    to_code, transform_stream, transform_file, SourceGenerator, Profile, SourceMap, SourceView, Template, RenderCache, \
+    CodeCache, patch_source, compare_ast, find_difference, fingerprint, ast_diff, dump_tree, load_tree, main, max_depth
 
 
 def src_to_tree(*src, mode='exec'):
@@ -37,6 +53,73 @@ class TestASTComparison(unittest.TestCase):
         src = inspect.getsource(inspect.getmodule(self.__class__))
         tree = ast.parse(src)
         self.assertTrue(compare_ast(tree, tree))
+        self.assertTrue(compare_ast(tree, ast.parse(src)))
+        self.assertIsNone(find_difference(tree, ast.parse(src)))
+
+    def test_difference(self):
+        self.assertFalse(compare_ast(ast.parse('a; b'), ast.parse('a')))  # One body is a prefix of the other
+        self.assertFalse(compare_ast(ast.parse('a(1)'), ast.parse('a(True)')))
+        self.assertEqual(find_difference(ast.parse('a; b'), ast.parse('a')), ('body',))
+        self.assertEqual(find_difference(ast.parse('a = b\nc = d'), ast.parse('a = b\nc = e')),
+                         ('body', 1, 'value', 'id'))
+        self.assertEqual(find_difference(ast.parse('a(b + c)'), ast.parse('a(b - c)')), ('body', 0, 'value', 'args', 0, 'op'))
+
+
+# Test structural hashes of ASTs
+class TestFingerprint(unittest.TestCase):
+    def test_equality(self):
+        src = inspect.getsource(inspect.getmodule(self.__class__))
+        self.assertEqual(fingerprint(ast.parse(src)), fingerprint(ast.parse(src)))
+        self.assertNotEqual(fingerprint(ast.parse('a(1)')), fingerprint(ast.parse('a(True)')))
+        self.assertNotEqual(fingerprint(ast.parse('a("b")')), fingerprint(ast.parse('a(b"b")')))
+        self.assertNotEqual(fingerprint(ast.parse('a; b')), fingerprint(ast.parse('b; a')))
+        self.assertEqual(fingerprint(ast.parse('a = 1').body[0].targets[0]), fingerprint(ast.parse('a').body[0].value))
+
+    def test_memo(self):
+        tree, memo = ast.parse('x = a + a * (a + a)'), {}
+        fingerprint(tree, memo)
+        value = tree.body[0].value
+        self.assertEqual(memo[id(value.left)], memo[id(value.right.left)])
+        self.assertEqual(memo[id(value.right.right)], fingerprint(ast.parse('a + a').body[0].value))
+        self.assertNotEqual(memo[id(value)], memo[id(value.right.right)])
+
+    def test_stable(self):  # Fingerprints don't depend on the hashes of strings, which differ between processes
+        code = 'import ast, xylem; print(xylem.fingerprint(ast.parse("def a(b, c=None): return b\'c\' or ...")))'
+        outputs = {subprocess.check_output([sys.executable, '-c', code], env=dict(os.environ, PYTHONHASHSEED=seed),
+                                           cwd=os.path.dirname(os.path.abspath(__file__))) for seed in ('1', '2')}
+        self.assertEqual(len(outputs), 1)
+
+
+# Test finding the statements changed between two ASTs
+class TestDiff(unittest.TestCase):
+    old = 'import a\ndef f(x):\n    y = 1\n    return y\nclass C:\n    def g(self):\n        pass\n' \
+          '    def h(self):\n        pass\nz = 2'
+    new = 'import a\nimport b\ndef f(x):\n    y = 2\n    return y\nclass C:\n    def h(self):\n        pass\n' \
+          '    def k(self):\n        pass'
+
+    def test_changes(self):
+        changes = ast_diff(ast.parse(self.old), ast.parse(self.new), source=True)
+        self.assertEqual([tuple(change) for change in changes],
+                         [('delete', ('body', 3), ('body', 1), 'z = 2', None),
+                          ('insert', ('body', 1), ('body', 1), None, 'import b'),
+                          ('modify', ('body', 1, 'body', 0), ('body', 2, 'body', 0), 'y = 1', 'y = 2'),
+                          ('delete', ('body', 2, 'body', 0), ('body', 3, 'body', 0), 'def g(self):\n    pass', None),
+                          ('insert', ('body', 2, 'body', 2), ('body', 3, 'body', 1), None, 'def k(self):\n    pass')])
+        self.assertEqual(ast_diff(ast.parse(self.old), ast.parse(self.old)), [])
+
+    def test_whole(self):  # Statements whose own fields changed are modified as a whole
+        old, new = ast.parse('if a:\n    b\nelse:\n    c'), ast.parse('if d:\n    b\nelse:\n    c')
+        changes = ast_diff(old, new)
+        self.assertEqual([(change.kind, change.old_path) for change in changes], [('modify', ('body', 0))])
+        self.assertIs(changes[0].new, new.body[0])
+        self.assertEqual(len(ast_diff(ast.parse('a', mode='eval'), ast.parse('b', mode='eval'))), 1)
+
+    def test_large(self):
+        old = ast.parse('\n'.join('x%d = f(%d)' % (i % 100, i) for i in range(20000)) + '\npass' * 1000)
+        new = ast.parse('\n'.join('x%d = f(%d)' % (i % 100, i) for i in range(20000) if i != 5000) + '\npass' * 999)
+        changes = ast_diff(old, new)
+        self.assertEqual([(change.kind, change.old_path) for change in changes],
+                         [('delete', ('body', 5000)), ('delete', ('body', 20000))])  # One of the identical passes
 
 
 class TestAtoms(unittest.TestCase):
@@ -80,6 +163,21 @@ class TestAtoms(unittest.TestCase):
         self.assertTrue(compare_trees(*dual_trees(*src)))
 
 
+# Test collections of constants, which are rendered all at once
+class TestConstantCollections(unittest.TestCase):
+    def test_collections(self):
+        src = ["[1, 2.5, 'a', b'b', None, True, 1j]", "(1, 'a')", "{1, 'a'}", "{1:'a', 'b':None}", '[1, ...]',
+               "{1:'a', **b}", '[]', '[[1, 2], [3]]']
+        self.assertEqual(src_to_src(*src), src)
+        self.assertEqual(to_source(ast.parse('(1,)'), max_line_length=80), '(1)')
+
+    def test_huge(self):
+        src = '[' + ', '.join(map(repr, range(100000))) + ']'
+        self.assertEqual(src_to_src(src), [src])
+        src = '{' + ', '.join("%r:'%d'" % (i, i) for i in range(100000)) + '}'
+        self.assertEqual(src_to_src(src), [src])
+
+
 # Test various miscellaneous expressions, like that produced by mode=eval()
 class TestExpressions(unittest.TestCase):
     # Test container expressions, which contain operators
@@ -290,9 +388,728 @@ class TestControlFlow(unittest.TestCase):
 
 class TestAsync(unittest.TestCase):  # TODO: Skip this before asyncio existed
     def test_async(self):
-        src = ['async def a():\n    await a\n    async for i in a:\n        a\n    async with a:\n        a']
+        src = ['async def a():\n    await a\n    async for i in a:\n        a\n    async with a:\n        a',
+               '@dec\nasync def a():\n    pass']
         self.assertTrue(compare_trees(*dual_trees(*src)))
 
 
+# Test overriding how nodes are rendered
+class TestSourceGenerator(unittest.TestCase):
+    class Generator(SourceGenerator):
+        def src_Name(self, node):
+            return node.id.upper()
+
+        def src_BinOp(self, node, parent_op=None, descend=0):
+            left = yield node.left
+            return 'op(' + left + ', ' + (yield node.right) + ')'
+
+    def test_default(self):
+        tree = ast.parse('a = b + c*d')
+        self.assertEqual(SourceGenerator().to_source(tree), to_source(tree))
+
+    def test_override(self):
+        tree = ast.parse('a = -(b + c*d) or e.f')
+        self.assertEqual(self.Generator().to_source(tree), 'A = -op(B, op(C, D)) or E.f')
+        self.assertEqual(to_source(tree), 'a = -(b+c*d) or e.f')
+
+    def test_functions(self):  # Every way of rendering can use a generator
+        tree, generator, expected = ast.parse('a = b + c\nd'), self.Generator(), 'A = op(B, C)\nD'
+        self.assertEqual(''.join(to_source_stream(tree, generator=generator)), expected)
+        text = io.StringIO()
+        to_source_to_file(tree, text, generator=generator)
+        self.assertEqual(text.getvalue(), expected)
+        with to_source_into(tree, bytearray(), generator=generator) as view:
+            self.assertEqual(view.tobytes(), expected.encode())
+        self.assertEqual(''.join(transform_stream(b'a = b + c\nd', generator=generator)), expected)
+        self.assertEqual(asyncio.run(to_source_async(tree, generator=generator)), expected)
+        self.assertEqual(to_code(ast.parse('b + c', mode='eval'), generator=generator).co_names, ('op', 'B', 'C'))
+        for workers in (1, 2):
+            results = list(to_source_many([tree, tree], workers=workers, chunksize=1, generator=generator))
+            self.assertEqual([result[1] for result in results], [expected, expected])
+
+    def test_lines(self):  # Statements of several lines are indented as a whole
+        class Generator(SourceGenerator):
+            def src_Pass(self, node):
+                return '# placeholder\n\npass'
+
+        tree = ast.parse('if a:\n    if b:\n        pass\nelse:\n    c')
+        expected = 'if a:\n    if b:\n        # placeholder\n\n        pass\nelse:\n    c'
+        generator, cache = Generator(), RenderCache()
+        self.assertEqual(generator.to_source(tree), expected)
+        for i in range(2):
+            self.assertEqual(generator.to_source(tree, cache=cache), expected)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(generator.to_source(tree.body[0].body[0]), 'if b:\n    # placeholder\n\n    pass')
+        self.assertEqual(SourceView(tree, generator)[0], expected)
+
+
+# Test recording statistics about rendering each type of node
+class TestProfile(unittest.TestCase):
+    def test_stats(self):
+        tree, profile = ast.parse('def a(b):\n    return b.c(d, e)\nf = a(1)'), Profile()
+        self.assertEqual(to_source(tree, profile=profile), to_source(tree))
+        stats = {name: stat for name, *stat in profile.stats()}
+        self.assertEqual(stats['Name'][0], 5)
+        self.assertEqual(stats['Call'][0], 2)
+        self.assertEqual(stats['Module'][3], 0)  # The lines of the module are all produced by its statements
+        self.assertEqual(stats['Return'][3], len('return '))
+        self.assertGreaterEqual(stats['FunctionDef'][1], stats['Return'][1])
+        self.assertGreaterEqual(profile.max_depth, 4)
+        to_source(tree, profile=profile)
+        self.assertEqual({name: stat[0] for name, *stat in profile.stats()}['Name'], 10)
+        profile.clear()
+        self.assertEqual(profile.stats(), [])
+
+
+# Test recording where each node was written
+class TestSourceMap(unittest.TestCase):
+    src = "@a\ndef b(c, d=1):\n    if c and (d or e):\n        return [x+1 for x in c]\n    f = {'é':g(h)}\n" \
+          "class i(j):\n    pass\nk = (l+m)*n - -o"
+
+    def assertLocated(self, tree, source, source_map):
+        expected = ast.parse(source)
+        self.assertTrue(compare_ast(tree, expected))
+        located = 0
+        for node, other in zip(ast.walk(tree), ast.walk(expected)):
+            if node in source_map and 'lineno' in node._attributes:
+                located += 1
+                self.assertEqual(source_map[node], (other.lineno, other.col_offset, other.end_lineno,
+                                                    other.end_col_offset))
+        self.assertGreater(located, 30)
+
+    def test_positions(self):
+        tree, source_map = ast.parse(self.src), SourceMap()
+        source = to_source(tree, source_map=source_map)
+        self.assertEqual(source, to_source(tree))
+        self.assertLocated(tree, source, source_map)
+        self.assertEqual(source_map[tree.body[0]], (2, 0, 5, 19))  # Starting after its decorators
+        self.assertEqual(source_map[tree.body[-1].value.left.left], (8, 5, 8, 8))  # Inside its parentheses
+        self.assertEqual(source_map[tree.body[0].body[1].value.keys[0]], (5, 9, 5, 13))  # Columns in UTF-8 bytes
+        self.assertNotIn(ast.Name(id='c'), source_map)
+
+    def test_wrapping(self):
+        tree, source_map = ast.parse(self.src), SourceMap()
+        source = to_source(tree, source_map=source_map, max_line_length=20)
+        self.assertEqual(source, to_source(tree, max_line_length=20))
+        self.assertLocated(tree, source, source_map)
+
+    def test_apply(self):
+        tree, source_map = ast.parse('x = (1, 2)\n\n\nif x:\n    y = f"{x}"'), SourceMap()
+        source = to_source(tree, source_map=source_map)
+        source_map.apply()
+        expected = ast.parse(source)
+        for node, other in zip(ast.walk(tree), ast.walk(expected)):
+            if isinstance(node, (ast.stmt, ast.Tuple, ast.JoinedStr)):
+                self.assertEqual((node.lineno, node.end_lineno), (other.lineno, other.end_lineno))
+        self.assertEqual(tree.body[1].lineno, 2)
+        self.assertEqual(tree.body[0].value.elts[0].col_offset, 4)  # Constants rendered with their tuple
+        compile(tree, '<test>', 'exec')
+
+
+# Test breaking long lines
+class TestWrapping(unittest.TestCase):
+    src = "x = {'a': [1, 2, f(b, c=d)], 'e': [g*2 for g in h if g%3 and g%5 or not g], **i}\n" \
+          "if a:\n    result = function(argument_one, argument_two and argument_three or argument_four, five)\n" \
+          "y = very_long_condition_number_one and very_long_condition_number_two or very_long_condition_three\n" \
+          "z = f'{function(argument_one, argument_two)}'"
+
+    def test_round_trip(self):
+        tree = ast.parse(self.src)
+        for width in (40, 60, 80, 1000):
+            result = to_source(tree, max_line_length=width)
+            self.assertTrue(compare_ast(ast.parse(result), tree))
+            for line in result.split('\n'):
+                if not line.startswith(('y = ', 'z = ')):  # Can't be broken outside of brackets, or in f-strings
+                    self.assertLessEqual(len(line), width)
+        self.assertEqual(to_source(tree, max_line_length=1000), to_source(tree))
+
+    def test_layout(self):
+        tree = ast.parse(self.src)
+        self.assertIn('\n    result = function(\n        argument_one,\n        argument_two and argument_three or '
+                      'argument_four,\n        five\n    )\n', to_source(tree, max_line_length=60))
+        self.assertIn("\n    'e':[g*2 for g in h if g%3 and g%5 or not g],\n", to_source(tree, max_line_length=60))
+
+    def test_cache(self):  # Statements rendered with and without wrapping aren't mixed up
+        tree, cache = ast.parse(self.src), RenderCache()
+        self.assertEqual(to_source(tree, cache=cache), to_source(tree))
+        self.assertEqual(to_source(tree, cache=cache, max_line_length=40), to_source(tree, max_line_length=40))
+        self.assertEqual(to_source(tree, cache=cache), to_source(tree))
+
+
+# Test producing the smallest source code
+class TestMinify(unittest.TestCase):
+    src = "import a, b\n@c\ndef d(e: int=1, *f, **g) -> int:\n    'Doc: string, = 1.0'\n" \
+          "    h = (1.0, 0.5, 1e16, 1e-05)\n    for (i, j) in f:\n        if i:\n            k += (i, j)\n" \
+          "        else:\n            return (i,)\n" \
+          "    return [x for x in g[(1, 2)] if x], {'l': 2.5}\nclass m:\n    pass"
+
+    def test_round_trip(self):
+        for source in (self.src, TestSourceMap.src, TestWrapping.src, TestStreaming.src):
+            tree = ast.parse(source)
+            result = to_source(tree, minify=True)
+            self.assertTrue(compare_ast(ast.parse(result), tree))
+            self.assertLess(len(result), len(to_source(tree)))
+
+    def test_output(self):
+        self.assertEqual(to_source(ast.parse(self.src), minify=True),
+                         "import a,b\n@c\ndef d(e:int=1,*f,**g)->int:\n 'Doc: string, = 1.0';h=1.,.5,1e16,1e-5\n"
+                         " for i,j in f:\n  if i:k+=i,j\n  else:return i,\n return [x for x in g[1,2] if x],{'l':2.5}\n"
+                         "class m:pass")
+
+    def test_options(self):
+        tree = ast.parse(self.src)
+        self.assertRaises(ValueError, to_source, tree, max_line_length=80, minify=True)
+        self.assertRaises(ValueError, to_source, tree, source_map=SourceMap(), minify=True)
+        cache = RenderCache()
+        self.assertEqual(to_source(tree, cache=cache), to_source(tree))
+        self.assertEqual(to_source(tree, cache=cache, minify=True), to_source(tree, minify=True))
+
+
+# Test rendering source code in chunks
+class TestStreaming(unittest.TestCase):
+    src = 'import a\nclass b:\n    def c(self):\n        pass\nd = a.e(b)'
+
+    def test_stream(self):
+        tree = ast.parse(self.src)
+        chunks = list(to_source_stream(tree))
+        self.assertEqual(''.join(chunks), to_source(tree))
+        self.assertEqual(len(chunks), 2*len(tree.body) - 1)
+
+    def test_file(self):
+        tree = ast.parse(self.src)
+        text, binary = io.StringIO(), io.BytesIO()
+        self.assertEqual(to_source_to_file(tree, text), len(self.src))
+        self.assertEqual(to_source_to_file(tree, binary), len(self.src))
+        self.assertEqual(text.getvalue(), self.src)
+        self.assertEqual(binary.getvalue(), self.src.encode())
+        binary = io.BytesIO()
+        self.assertEqual(to_source_to_file(tree, binary, encoding='utf-16'), len(self.src.encode('utf-16')))
+        self.assertEqual(binary.getvalue(), self.src.encode('utf-16'))  # With a single BOM
+
+
+# Test transforming files a statement at a time
+class TestTransformStream(unittest.TestCase):
+    # Lines at the start of a line that don't start statements, in strings, brackets and continued statements
+    src = b'# -*- coding: latin-1 -*-\n"""Doc\nx = 1\n"""\nimport a\n@b\ndef c(d=\'\\\'\\\n""",\'):\n' + \
+          b'    return [\ne,\n# ]\nf]\nif g:\n    pass\nelse:\n    h = \\\n"\xe9"\n\n\n# Comment\n' + \
+          b'try:\n    i\nexcept j:\n    pass\nfinally:\n    k; l\nm = r"\\\\"\nn = """a\n\'\'\'"""\n'
+
+    def test_source(self):
+        expected = to_source(ast.parse(self.src))
+        self.assertEqual(''.join(transform_stream(self.src)), expected)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'a.py')
+            with open(path, 'wb') as f:
+                f.write(self.src)
+            self.assertEqual(''.join(transform_stream(path)), expected)
+            with open(path, 'wb'):
+                pass
+            self.assertEqual(list(transform_stream(path)), [])
+        output = io.BytesIO()
+        self.assertEqual(transform_file(self.src, output, encoding='latin-1'), len(expected))
+        self.assertEqual(output.getvalue().decode('latin-1'), expected)
+
+    def test_transformers(self):
+        class Rename(ast.NodeTransformer):
+            def __init__(self):
+                self.lines = []
+
+            def visit_Name(self, node):
+                self.lines.append(node.lineno)
+                return ast.Name(id=node.id.upper(), ctx=node.ctx)
+
+        class Drop(ast.NodeTransformer):
+            def visit_Import(self, node):
+                return None
+
+            def visit_Expr(self, node):
+                return [node, node]
+
+        rename = Rename()
+        source = ''.join(transform_stream(self.src, [rename, Drop()]))
+        self.assertEqual(source, to_source(Drop().visit(Rename().visit(ast.parse(self.src)))))
+        self.assertNotIn('import', source)
+        self.assertEqual(sorted(rename.lines[:3]), [6, 10, 12])  # Lines of the whole source
+
+    def test_invalid(self):
+        with self.assertRaises(SyntaxError) as context:
+            list(transform_stream(b'a = 1\nb = 2\nc = (\nd = 4\n'))
+        self.assertEqual(context.exception.lineno, 3)
+
+
+# Test rendering definitions on demand
+class TestSourceView(unittest.TestCase):
+    src = 'import a\nclass B(c):\n    x = 1\n    def d(self):\n        def e():\n            pass\n' + \
+          '        return e\nif f:\n    async def g():\n        class H:\n            pass\ntry:\n    i\n' + \
+          'except j:\n    def k():\n        pass'
+
+    def test_names(self):
+        view = SourceView(ast.parse(self.src))
+        self.assertEqual(list(view.definitions), ['B', 'B.d', 'B.d.<locals>.e', 'g', 'g.<locals>.H', 'k'])
+        self.assertEqual(view['B.d.<locals>.e'], 'def e():\n    pass')
+        self.assertEqual(view['g.<locals>.H'], 'class H:\n    pass')
+        self.assertIn('k', view)
+        self.assertNotIn('e', view)
+        with self.assertRaises(KeyError):
+            view['e']
+
+    def test_statements(self):
+        tree = ast.parse(self.src)
+        view = SourceView(tree)
+        self.assertEqual(len(view), 4)
+        self.assertEqual(view[0], 'import a')
+        self.assertEqual(view[-1], to_source(tree.body[-1]))
+        self.assertEqual(view[:2], to_source(ast.Module(body=tree.body[:2], type_ignores=[])))
+        self.assertEqual(str(view), self.src)
+        self.assertIs(view['B'], view[1])  # Rendered once
+        self.assertEqual(str(SourceView(tree, max_line_length=10)), to_source(tree, max_line_length=10))
+
+
+# Test encoding source into buffers
+class TestSourceInto(unittest.TestCase):
+    src = 'a = \'é\'\ndef b(c):\n    return c\nd = [1, 2, 3]'
+
+    def test_bytearray(self):
+        buffer = bytearray()
+        tree = ast.parse(self.src)
+        with to_source_into(tree, buffer) as view:
+            self.assertEqual(view.tobytes(), self.src.encode())
+        with to_source_into(tree.body[0], buffer) as view:  # Reused, without shrinking
+            self.assertEqual(view.tobytes(), b"a = '\xc3\xa9'")
+        self.assertEqual(len(buffer), len(self.src.encode()))
+        with to_source_into(tree, buffer, offset=2, encoding='latin-1') as view:
+            self.assertEqual(view.tobytes(), self.src.encode('latin-1'))
+        self.assertEqual(bytes(buffer[:2]), b"a ")
+        with to_source_into(tree, buffer, offset=len(buffer), encoding='utf-16') as view:  # With a single BOM
+            self.assertEqual(view.tobytes(), self.src.encode('utf-16'))
+        for offset in (-1, len(buffer) + 1):
+            self.assertRaises(ValueError, to_source_into, tree, buffer, offset=offset)
+        self.assertRaises(ValueError, to_source_into, tree, bytearray(b'xy'), offset=5)
+
+    def test_fixed(self):
+        tree = ast.parse(self.src)
+        size = len(self.src.encode())
+        buffer = memoryview(bytearray(size + 1))
+        with to_source_into(tree, buffer) as view:
+            self.assertEqual(view.tobytes(), self.src.encode())
+        self.assertRaises(ValueError, to_source_into, tree, buffer, offset=2)
+
+
+# Test rendering in slices from asyncio tasks
+class TestAsyncRendering(unittest.TestCase):
+    # Block statements holding enough statements to be split into slices, including elif chains and handlers
+    src = 'import a\n@b\nclass c(d):\n    def e(self):\n' + \
+          ''.join('        f{} = {}\n'.format(i, i) for i in range(40)) + \
+          '        if a:\n            pass\n        elif b:\n' + '            g = é\n' * 40 + \
+          '        try:\n            h\n        except i:\n            j\n' + '    k = 1\n' * 40 + 'l = m'
+
+    def test_source(self):
+        tree = ast.parse(self.src)
+        self.assertEqual(asyncio.run(to_source_async(tree)), self.src)
+        self.assertEqual(asyncio.run(to_source_async(tree, max_line_length=40)), to_source(tree, max_line_length=40))
+        self.assertEqual(asyncio.run(to_source_async(tree.body[0])), 'import a')
+
+    def test_pauses(self):  # Other tasks run while rendering
+        async def count(counter, done):
+            while not done.is_set():
+                counter[0] += 1
+                await asyncio.sleep(0)
+
+        async def render():
+            counter, done = [0], asyncio.Event()
+            task = asyncio.ensure_future(count(counter, done))
+            source = await to_source_async(ast.parse(self.src), interval=0)
+            done.set()
+            await task
+            return source, counter[0]
+        source, count = asyncio.run(render())
+        self.assertEqual(source, self.src)
+        self.assertGreater(count, 80)  # At least once per slice
+
+    def test_writer(self):
+        async def render(encoding):
+            first, second = socket.socketpair()
+            reader, other = await asyncio.open_connection(sock=first)  # Closed once the writers are collected
+            _, writer = await asyncio.open_connection(sock=second)
+            written = asyncio.ensure_future(to_source_async(ast.parse(self.src), writer, encoding, interval=0))
+            data = b''
+            while len(data) < len(self.src.encode(encoding)):
+                data += await reader.read(65536)
+            result = await written
+            writer.close()
+            other.close()
+            return result, data
+        for encoding in ('utf-8', 'utf-16'):  # With a single BOM
+            written, data = asyncio.run(render(encoding))
+            self.assertEqual(data, self.src.encode(encoding))
+            self.assertEqual(written, len(data))
+
+
+# Test reusing the source of unchanged statements
+class TestRenderCache(unittest.TestCase):
+    src = 'import a\nclass b:\n    def c(self):\n        if a:\n            return d\n        return e\nf = a.g(b)'
+
+    def test_reuse(self):
+        tree, cache = ast.parse(self.src), RenderCache()
+        self.assertEqual(to_source(tree, cache=cache), self.src)
+        self.assertEqual(to_source(tree, cache=cache), self.src)
+        self.assertEqual(cache.hits, len(tree.body))
+
+    def test_changes(self):
+        tree, cache = ast.parse(self.src), RenderCache()
+        to_source(tree, cache=cache)
+        function = tree.body[1].body[0]
+        function.body[0].body[0].value.id = 'x'  # Change a field deep inside the class
+        function.body.append(ast.Pass())  # Change a list of statements
+        self.assertEqual(to_source(tree, cache=cache), to_source(tree))
+        self.assertIn('return x', to_source(tree, cache=cache))
+
+    def test_invalidate(self):
+        tree, cache = ast.parse(self.src), RenderCache(check=False)
+        to_source(tree, cache=cache)
+        statement = tree.body[1].body[0].body[0].body[0]
+        statement.value.id = 'x'
+        self.assertEqual(to_source(tree, cache=cache), self.src)
+        cache.invalidate(statement)  # Should also invalidate the enclosing if, function and class
+        self.assertEqual(to_source(tree, cache=cache), to_source(tree))
+        self.assertIn('return x', to_source(tree, cache=cache))
+
+    def test_indentation(self):  # Cached statements moved to a different level
+        tree, cache = ast.parse(self.src), RenderCache()
+        to_source(tree, cache=cache)
+        function = tree.body[1].body.pop()
+        tree.body.append(function)
+        tree.body[1].body.append(ast.Pass())
+        self.assertEqual(to_source(tree, cache=cache), to_source(tree))
+
+    def test_eviction(self):
+        tree, cache = ast.parse(self.src), RenderCache(maxsize=2)
+        for i in range(3):
+            self.assertEqual(to_source(tree, cache=cache), self.src)
+            self.assertLessEqual(len(cache), 2)
+
+
+# Test regenerating source code from modified trees, keeping unchanged statements as they were written
+class TestPatchSource(unittest.TestCase):
+    src = '#!/usr/bin/env python\nimport a  # comment\n\n\nclass b:\n    """ doc """\n    def c(self):\n' \
+          '        x = (1 +\n             2)  # comment\n        return x\n\n@d\ndef e(): pass\nf = 1; g = 2\n'
+
+    def test_unchanged(self):
+        self.assertEqual(patch_source(self.src, ast.parse(self.src)), self.src)
+        self.assertEqual(patch_source(self.src.replace('\n', '\r\n'), ast.parse(self.src)),
+                         self.src.replace('\n', '\r\n'))
+        src = '# Only a comment\n\n'
+        self.assertEqual(patch_source(src, ast.parse(src)), src)
+        self.assertEqual(patch_source('', ast.parse('')), '')
+
+    def test_original(self):  # Given the original tree, the source isn't parsed again
+        original = ast.parse(self.src)
+        tree = ast.Module(body=original.body[:2] + [ast.Pass()] + original.body[2:], type_ignores=[])
+        self.assertEqual(patch_source(self.src, original, original), self.src)
+        self.assertEqual(patch_source(self.src, tree, original), patch_source(self.src, tree))
+
+    def test_comments(self):  # Comments and blank lines around inserted and changed statements are kept
+        src = 'import os  # why\n# keep\n\nx = 1\ny = 2\n\n# about z\nz = 3\n'
+        tree = ast.parse(src)
+        tree.body.insert(1, ast.Pass())
+        self.assertEqual(patch_source(src, tree), src.replace('# keep', 'pass\n# keep'))
+        tree = ast.parse(src)
+        tree.body[2].value.value = 4
+        del tree.body[1]
+        self.assertEqual(patch_source(src, tree), 'import os  # why\ny = 4\n\n# about z\nz = 3\n')
+
+    def test_changes(self):
+        tree = ast.parse(self.src)
+        tree.body[1].body[1].body[1].value.id = 'y'
+        tree.body.append(ast.Pass())
+        result = patch_source(self.src, tree)
+        self.assertTrue(compare_ast(ast.parse(result), tree))
+        self.assertIn('import a  # comment\n', result)
+        self.assertIn('        x = (1 +\n             2)  # comment\n        return y\n', result)
+        self.assertTrue(result.endswith('f = 1; g = 2\npass'))
+
+    def test_moved(self):  # Statements moved to another level of indentation are rendered again
+        tree = ast.parse(self.src)
+        tree.body.append(tree.body[1].body.pop())
+        result = patch_source(self.src, tree)
+        self.assertTrue(compare_ast(ast.parse(result), tree))
+        self.assertIn('\ndef c(self):\n    x = 1+2\n', result)
+
+
+# Test converting batches of files and trees across worker processes
+class TestBatch(unittest.TestCase):
+    def test_many(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ('a.py', 'b.py', 'c.py')]
+            for path, src in zip(paths, ['a = 1', 'def b(:', '# -*- coding: latin-1 -*-\nc = "\xe9"']):
+                with open(path, 'w', encoding='latin-1') as f:
+                    f.write(src)
+            output = os.path.join(directory, 'out', 'c.py')
+            items = [paths[0], paths[1], (paths[2], output), ast.parse('d(e)')]
+            for workers in (1, 2):
+                results = list(to_source_many(items, workers=workers, chunksize=1))
+                self.assertEqual([result[0] for result in results], items)
+                self.assertEqual([result[1] for result in results], ['a = 1', None, "c = 'é'", 'd(e)'])
+                self.assertIsInstance(results[1][2], SyntaxError)
+                with open(output, encoding='utf-8') as f:
+                    self.assertEqual(f.read(), "c = 'é'\n")
+
+    def test_not_paths(self):  # Anything else is an error, rather than a file descriptor to open
+        results = list(to_source_many([0, (ast.parse('a'), 1), ast.parse('b')], workers=1))
+        self.assertIsInstance(results[0][2], TypeError)
+        self.assertIsInstance(results[1][2], TypeError)
+        self.assertEqual(results[2][1:], ('b', None))
+
+
+# Test filling in the holes of templates
+class TestTemplate(unittest.TestCase):
+    source = 'def NAME(self, x=DEFAULT):\n    if x > LIMIT:\n        BODY\n    return self.FIELD(-VALUE * x, key=NAME)'
+
+    def test_substitute(self):
+        template = Template(self.source, ['NAME', 'DEFAULT', 'LIMIT', 'BODY', 'FIELD', 'VALUE'])
+        body = ast.parse('x = 0\nif x:\n    pass').body
+        source = template.substitute(NAME='f', DEFAULT=None, LIMIT=ast.parse('a or b').body[0].value, BODY=body,
+                                     FIELD='g', VALUE=ast.parse('a + b').body[0].value)
+        expected = 'def f(self, x=None):\n    if x>(a or b):\n        x = 0\n        if x:\n            pass\n' \
+                   '    return self.g(-(a+b)*x, key=f)'
+        self.assertEqual(source, expected)
+        self.assertEqual(source, to_source(ast.parse(expected)))
+        source = template.substitute({'NAME': 'f', 'DEFAULT': 1.5, 'LIMIT': 'n', 'BODY': []}, FIELD='g', VALUE=2)
+        self.assertIn('x=1.5', source)
+        self.assertIn('        pass\n', source)
+        self.assertIn('-2*x', source)
+
+    def test_constants(self):  # Parenthesized where the source would otherwise mean something else
+        self.assertEqual(Template('x = OP ** 2', ['OP']).substitute(OP=-1), 'x = (-1)**2')
+        self.assertEqual(Template('x = 2 ** OP', ['OP']).substitute(OP=-1), 'x = 2**-1')
+        self.assertEqual(Template('y = OP.real', ['OP']).substitute(OP=1), 'y = (1).real')
+        self.assertEqual(Template('y = OP.real', ['OP']).substitute(OP=1.5), 'y = 1.5.real')
+        self.assertEqual(Template('y = OP[0] + OP(1)', ['OP']).substitute(OP=-2), 'y = (-2)[0]+(-2)(1)')
+        self.assertEqual(Template('y = f(OP)', ['OP']).substitute(OP=-2), 'y = f(-2)')
+        self.assertEqual(Template('y = OP.real', ['OP']).substitute(OP=ast.parse('a + b').body[0].value),
+                         'y = (a+b).real')
+
+    def test_missing(self):
+        template = Template(self.source, ['NAME', 'DEFAULT'])
+        self.assertRaises(KeyError, template.substitute, NAME='f')
+        self.assertRaises(ValueError, Template, "f'{NAME}'", ['NAME'])
+
+
+# Test encoding trees as bytes
+class TestDumpTree(unittest.TestCase):
+    def assertSame(self, tree, other):
+        self.assertEqual(ast.dump(other, include_attributes=True), ast.dump(tree, include_attributes=True))
+
+    def test_round_trip(self):
+        tree = ast.parse(inspect.getsource(inspect.getmodule(TestDumpTree)))
+        data = dump_tree(tree)
+        self.assertSame(tree, load_tree(data))
+        self.assertLess(len(data), len(pickle.dumps(tree, protocol=pickle.HIGHEST_PROTOCOL)) // 2)
+        self.assertSame(tree, load_tree(memoryview(data)))
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                self.assertSame(tree, load_tree(view))
+
+    def test_values(self):
+        values = [1, 1.0, True, -0.0, 0.0, b'1', '1', None, ..., 10**100, 1j, (1, 'a')]
+        loaded = load_tree(dump_tree(ast.Tuple(elts=[ast.Constant(value=value) for value in values])))
+        self.assertEqual([repr(node.value) for node in loaded.elts], list(map(repr, values)))
+        name = ast.Name(id='a')  # Built by hand, without ctx or a location
+        loaded = load_tree(dump_tree(ast.Expression(body=ast.BinOp(left=name, op=ast.Add(), right=ast.Constant(
+            value=frozenset([1]), lineno=1, col_offset=0, end_lineno=None, end_col_offset=None)))))
+        self.assertFalse(hasattr(loaded.body.left, 'lineno'))
+        self.assertIs(type(loaded.body.left.ctx), type(getattr(name, 'ctx', None)))  # Filled in from Python 3.13
+        self.assertEqual(loaded.body.right.value, frozenset([1]))
+        self.assertIsNone(loaded.body.right.end_lineno)
+
+    def test_wide(self):  # Too many strings or lines for 16-bit arrays
+        tree = ast.parse('\n'.join('a{} = {}'.format(i, i) for i in range(40000)))
+        self.assertSame(tree, load_tree(dump_tree(tree)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, load_tree, b'not a tree')
+
+    def test_truncated(self):
+        data = dump_tree(ast.parse('a = b(1, "c")'))
+        for size in range(len(data)):
+            self.assertRaises(ValueError, load_tree, data[:size])
+        size = int.from_bytes(data[8:12], 'little')  # Of the table of types and constants, following the header
+        end = 20 + size
+        self.assertRaises(ValueError, load_tree, data[:end-size//2] + bytes(size//2) + data[end:])  # Corrupted table
+
+
+# Test compiling rendered trees, and storing the code on disk
+class TestCodeCache(unittest.TestCase):
+    src = 'def a(b):\n    return b*2\nc = a(21)'
+
+    def test_to_code(self):
+        namespace = {}
+        exec(to_code(ast.parse(self.src), 'a.py'), namespace)
+        self.assertEqual(namespace['c'], 42)
+        self.assertEqual(namespace['a'].__code__.co_filename, 'a.py')
+        self.assertEqual(eval(to_code(ast.parse('1 + 2', mode='eval'))), 3)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = CodeCache(os.path.join(directory, 'code'))
+            code = to_code(ast.parse(self.src), 'a.py', cache=cache)
+            other = CodeCache(os.path.join(directory, 'code'))  # As in another process
+            self.assertEqual(to_code(ast.parse(self.src), 'a.py', cache=other), code)
+            self.assertEqual((cache.hits, cache.misses, other.hits, other.misses), (0, 1, 1, 0))
+            to_code(ast.parse(self.src), 'b.py', cache=other)
+            to_code(ast.parse(self.src.replace('21', '22')), 'a.py', cache=other)
+            self.assertEqual((len(other), other.misses), (3, 2))
+            for name in os.listdir(cache.directory):  # Corrupted code is compiled again
+                with open(os.path.join(cache.directory, name), 'wb') as f:
+                    f.write(b'corrupted')
+            self.assertEqual(to_code(ast.parse(self.src), 'a.py', cache=cache), code)
+            self.assertEqual(cache.misses, 2)
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            trees = [ast.parse('a = {}'.format(i)) for i in range(20)]
+            size = len(marshal.dumps(to_code(trees[0]))) + 16
+            cache = CodeCache(directory, maxsize=size * 10)
+            for i, tree in enumerate(trees):
+                to_code(tree, cache=cache)
+                os.utime(os.path.join(directory, sorted(os.listdir(directory), key=lambda name: os.stat(
+                    os.path.join(directory, name)).st_mtime_ns)[-1]), ns=(i * 10**9, i * 10**9))
+            self.assertLessEqual(sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)),
+                                 size * 10)
+            to_code(trees[-1], cache=cache)  # The most recently used code is kept
+            self.assertEqual(cache.hits, 1)
+
+    def test_threads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = CodeCache(directory, maxsize=4096)
+            trees = [ast.parse('a = {}'.format(i % 40)) for i in range(400)]
+            with futures.ThreadPoolExecutor(8) as executor:
+                codes = list(executor.map(lambda tree: to_code(tree, cache=cache), trees))
+            for tree, code in zip(trees, codes):
+                namespace = {}
+                exec(code, namespace)
+                self.assertEqual(namespace['a'], tree.body[0].value.value)
+            self.assertFalse([name for name in os.listdir(directory) if name.endswith('.tmp')])
+
+
+# Test the command line interface
+class TestCommandLine(unittest.TestCase):
+    def test_directories(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source, output, cache = [os.path.join(directory, name) for name in ('src', 'out', 'cache.json')]
+            os.makedirs(os.path.join(source, 'pkg'))
+            for name, src in [('a.py', 'a  =  1\n'), ('pkg/b.py', 'def b( c ):\n  return c\n'), ('c.txt', 'c')]:
+                with open(os.path.join(source, name), 'w') as f:
+                    f.write(src)
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                self.assertEqual(main([source, '-o', output, '-j', '1']), 0)
+                self.assertEqual(sorted(os.listdir(output)), ['a.py', 'pkg'])
+                with open(os.path.join(output, 'pkg', 'b.py')) as f:
+                    self.assertEqual(f.read(), 'def b(c):\n    return c\n')
+                main([source, '-o', output, '-j', '1'])  # Up to date
+                self.assertIn('0 converted, 2 skipped', stderr.getvalue())
+                main([source, '-i', '--cache', cache, '-j', '1'])
+                with open(os.path.join(source, 'a.py')) as f:
+                    self.assertEqual(f.read(), 'a = 1\n')
+                os.utime(os.path.join(source, 'a.py'))  # Touched, but unchanged
+                main([source, '-i', '--cache', cache, '-j', '1'])
+                self.assertIn('0 converted, 2 skipped', stderr.getvalue().splitlines()[-1])
+                with open(os.path.join(source, 'a.py'), 'w') as f:
+                    f.write('def (')
+                self.assertEqual(main([source, '-i', '--cache', cache, '-j', '1']), 1)
+                self.assertIn('a.py: SyntaxError', stderr.getvalue())
+
+    def test_stdout(self):  # Each source printed is preceded by its path, and only converted files count as throughput
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ('a.py', 'b.py', 'c.py')]
+            for path, src in zip(paths, ['a  =  1', 'def (', 'c ( )']):
+                with open(path, 'w') as f:
+                    f.write(src)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout, \
+                    contextlib.redirect_stderr(io.StringIO()) as stderr, \
+                    mock.patch('xylem.time.perf_counter', side_effect=[0.0, 4.0]):
+                self.assertEqual(main([directory, '-j', '1']), 1)
+            self.assertEqual(stdout.getvalue(), '# {}\na = 1\n# {}\nc()\n'.format(paths[0], paths[2]))
+            self.assertIn('2 converted, 0 skipped, 1 failed in 4.00s (0.5 files/s, 3 bytes/s)', stderr.getvalue())
+
+
+# Test rendering in many threads at once
+class TestThreads(unittest.TestCase):
+    src = inspect.getsource(inspect.getmodule(TestASTComparison))
+
+    def render(self, threads, trees, **kwargs):
+        barrier = threading.Barrier(threads)
+
+        def render(tree):
+            barrier.wait()
+            return to_source(tree, **kwargs)
+        with futures.ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(render, trees))
+
+    def test_shared_state(self):
+        trees = [ast.parse(self.src) for i in range(8)]
+        expected, single = to_source(trees[0]), Profile()
+        to_source(trees[0], profile=single)
+        profile, cache = Profile(), RenderCache(maxsize=65536)  # Room for every statement of all the trees
+        self.assertEqual(self.render(8, trees, profile=profile), [expected] * 8)
+        self.assertEqual(self.render(8, trees, cache=cache), [expected] * 8)
+        self.assertEqual(self.render(8, trees, cache=cache), [expected] * 8)
+        self.assertEqual(cache.hits, 8 * len(trees[0].body))
+        calls = {name: stat[0] * 8 for name, *stat in single.stats()}
+        self.assertEqual({name: stat[0] for name, *stat in profile.stats()}, calls)
+        self.assertEqual(profile.max_depth, single.max_depth)
+
+    @unittest.skipIf(getattr(sys, '_is_gil_enabled', lambda: True)(), 'requires a free-threaded interpreter')
+    def test_scaling(self):
+        threads = min(4, os.cpu_count() or 1)
+        if threads < 2:
+            self.skipTest('requires several CPUs')
+        trees = [ast.parse(self.src) for i in range(threads * 4)]
+        start = time.perf_counter()
+        self.render(1, trees)
+        serial = time.perf_counter() - start
+        start = time.perf_counter()
+        self.render(threads, trees)
+        self.assertLess(time.perf_counter() - start, serial / (threads / 2))
+
+
+# Test that trees nested far deeper than the recursion limit can still be rendered
+class TestDeepTrees(unittest.TestCase):
+    def test_BinOp_chain(self):
+        n = sys.getrecursionlimit() * 5
+        node = ast.Name(id='a0', ctx=ast.Load())
+        for i in range(1, n):
+            node = ast.BinOp(left=node, op=ast.Add(), right=ast.Name(id='a%d' % i, ctx=ast.Load()))
+        expected = '+'.join('a%d' % i for i in range(n))
+        self.assertEqual(expected, to_source(ast.Expression(body=node)))
+
+    def test_nested_If(self):
+        n = sys.getrecursionlimit() * 2
+        tree = ast.Module(body=[])
+        body = tree.body
+        for i in range(n):
+            node = ast.If(test=ast.Name(id='a', ctx=ast.Load()), body=[], orelse=[])
+            body.append(node)
+            body = node.body
+        body.append(ast.Pass())
+        lines = to_source(tree).split('\n')
+        self.assertEqual(n + 1, len(lines))
+        self.assertEqual(' '*4*n + 'pass', lines[-1])
+
+    def test_compare(self):
+        n = sys.getrecursionlimit() * 5
+        trees = [ast.Name(id='a', ctx=ast.Load()), ast.Name(id='a', ctx=ast.Load())]
+        for i in range(n):
+            trees = [ast.UnaryOp(op=ast.USub(), operand=tree) for tree in trees]
+        self.assertTrue(compare_ast(*trees))
+        trees[1].operand.operand.op = ast.UAdd()
+        self.assertFalse(compare_ast(*trees))
+        self.assertEqual(find_difference(*trees), ('operand', 'operand', 'op'))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=3)
@@ -26,14 +26,94 @@ Convert Python Abstract Syntax Trees (ASTs) to source code.
 
 Copyright (C) 2018 Ariel Antonitis. Licensed under the MIT License.
 """
+import re
+import os
+import sys
 import ast
+import io
+import codecs
+import gc
+import json
+import struct
+import marshal
+import tempfile
+import time
+import array
+import mmap
+import copy
+import hashlib
+import threading
+import argparse
+import operator
+import bisect
+import tokenize
+import importlib.util
+import functools
+import collections
+from concurrent import futures
 
 
 __version__ = '0.10.0'
 url = 'https://github.com/arantonitis/xylem'
 
+# Source generators are written as Python generators: instead of calling to_source on a child node, they yield it
+# and are sent back its source. Yielding a list of nodes sends back a list of sources, and yielding a
+# (node, parent_op, descend) tuple renders an operand in the context of its parent operator.
+# This lets to_source drive rendering with an explicit stack rather than recursion.
+# Block statements yield each of their lines as a str instead, which to_source writes out once at the current
+# indentation level; yielding _INDENT or _DEDENT moves that level.
+_INDENT, _DEDENT = 1, -1
 
-def _src_Module(node): return '\n'.join(to_source(child) for child in node.body)
+# When wrapping long lines, bracketed expressions and boolean chains are rendered as groups: _OPEN and _CLOSE surround
+# the items between a pair of brackets, _GROUP and _END surround a boolean chain, and _LINE separates items, rendering
+# as a space or as a line break. repr escapes all of them, so they can't appear in the source of any literal
+_OPEN, _LINE, _CLOSE, _GROUP, _END = '\x01', '\x02', '\x03', '\x05', '\x06'
+_markers = re.compile('([\x01\x02\x03\x05\x06])')
+_flat = str.maketrans({_OPEN: None, _LINE: ' ', _CLOSE: None, _GROUP: None, _END: None})
+
+# When recording a SourceMap, the source of each node is surrounded by _START, followed by the node's index and _MARK,
+# and _STOP. Block statements write these on lines of their own before and after their lines instead
+_START, _MARK, _STOP = '\x0e', '\x10', '\x0f'
+_positions = re.compile('\x0e(\\d+)\x10|\x0f')
+
+
+def _flatten(source):  # Removes every marker from the source of a node that can't be broken across lines
+    source = source.translate(_flat)
+    return _positions.sub('', source) if _START in source else source
+
+
+def _brackets(open, items, close, wrap=False, sep=', '):
+    # Joins items between brackets, as a group that can be broken across lines when wrap is True
+    if wrap and items:
+        return open + _OPEN + (sep[:-1] + _LINE).join(items) + _CLOSE + close
+    return open + sep.join(items) + close
+
+
+def _bare(node):
+    # When minifying, tuples are rendered without parentheses where they're optional, by yielding a generator that
+    # renders them that way in place of the node
+    if node.__class__ is ast.Tuple and node.elts and not any(isinstance(elt, ast.Starred) for elt in node.elts):
+        return _bare_tuple(node)
+    return node
+
+
+def _bare_tuple(node):
+    elts = yield node.elts
+    return ','.join(elts) + (',' if len(elts) == 1 else '')
+
+
+def _block(nodes, indent=True):  # Renders a list of statements, one level deeper than their parent by default
+    if indent:
+        yield _INDENT
+    for node in nodes:
+        line = yield node
+        if line is not None:  # Simple statements return their line rather than yielding it
+            yield line
+    if indent:
+        yield _DEDENT
+
+
+def _src_Module(node): return (yield from _block(node.body, indent=False))
 
 
 def _src_Num(node): return repr(node.n)
@@ -45,37 +125,98 @@ def _src_Str(node): return repr(node.s)
 def _src_Bytes(node): return repr(node.s)
 
 
+def _short_repr(value):  # The shortest source of a constant, writing floats like 0.5 as .5, 1.0 as 1. and 1e+16 as 1e16
+    if value.__class__ is not float:
+        return repr(value)
+    mantissa, e, exponent = repr(value).partition('e')
+    if mantissa.endswith('.0'):
+        mantissa = mantissa[:-1]
+    elif mantissa.startswith('0.'):
+        mantissa = mantissa[1:]
+    return mantissa + e + ('-' if exponent.startswith('-') else '') + exponent.lstrip('+-').lstrip('0')
+
+
+def _src_Constant(node, minify=False):
+    if node.value is Ellipsis:
+        return '...'
+    return _short_repr(node.value) if minify else repr(node.value)
+
+
 def _src_JoinedStr(node, raw=False):
-    f_string = ''.join(_src_FormattedValue(value, raw=True) if isinstance(value, ast.FormattedValue) else value.s
-                       for value in node.values)
+    l = []
+    for value in node.values:
+        if isinstance(value, ast.FormattedValue):
+            l.append((yield from _src_FormattedValue(value, raw=True)))
+        else:
+            l.append(value.s)
+    f_string = ''.join(l)
     return f_string if raw else 'f' + repr(f_string)
 
 
 def _src_FormattedValue(node, raw=False):
-    value = to_source(node.value)
+    value = _flatten((yield node.value))  # Lines can't be broken or located inside f-strings
     l = ['{', value]
     if node.format_spec is not None:
         l.append(':')
-        l.append(_src_JoinedStr(node.format_spec, raw=True))
+        l.append((yield from _src_JoinedStr(node.format_spec, raw=True)))
     if node.conversion != -1:
         l.append('!' + chr(node.conversion))
     l.append('}')
     return ''.join(l) if raw else 'f' + repr(''.join(l))
 
 
-def _src_List(node): return '[' + ', '.join(to_source(e) for e in node.elts) + ']'
-
-
-def _src_Tuple(node): return '(' + ', '.join(to_source(e) for e in node.elts) + ')'
-
+_Constant = getattr(ast, 'Constant', None)  # Added in Python 3.6
+_get_class, _get_value = operator.attrgetter('__class__'), operator.attrgetter('value')
 
-def _src_Set(node): return '{' + ', '.join(to_source(e) for e in node.elts) + '}'
 
-
-def _src_Dict(node):
-    # Create a generator consisting of all key=value and **value pairs in the node, then join them
-    return '{' + ', '.join('**' + value if key is None else key + ':' + value
-                           for key, value in zip(map(to_source, node.keys), map(to_source, node.values))) + '}'
+def _constants(nodes):
+    # Returns the values of a list of constants (other than Ellipsis, whose repr isn't ...), or None if the list has
+    # anything else in it. Huge literals can then be rendered with a single repr or join, instead of element by element
+    if not nodes or nodes[0].__class__ is not _Constant or nodes[-1].__class__ is not _Constant or \
+            set(map(_get_class, nodes)) != {_Constant}:
+        return None
+    values = list(map(_get_value, nodes))
+    return None if Ellipsis in values else values
+
+
+def _src_List(node, wrap=False, minify=False):
+    values = _constants(node.elts)
+    if values is None:
+        return _brackets('[', (yield node.elts), ']', wrap)
+    if minify:
+        return '[' + ','.join(map(_short_repr, values)) + ']'
+    return _brackets('[', list(map(repr, values)), ']', wrap) if wrap else repr(values)
+
+
+def _src_Tuple(node, wrap=False, minify=False):
+    values = _constants(node.elts)
+    if values is None:
+        return _brackets('(', (yield node.elts), ')', wrap)
+    if minify:
+        return '(' + ','.join(map(_short_repr, values)) + (',)' if len(values) == 1 else ')')
+    if wrap or len(values) == 1:  # Rendered as (a) rather than repr's (a,), like other tuples of one element
+        return _brackets('(', list(map(repr, values)), ')', wrap)
+    return repr(tuple(values))
+
+
+def _src_Set(node, wrap=False, minify=False):
+    values = _constants(node.elts)
+    if values is not None and minify:
+        return '{' + ','.join(map(_short_repr, values)) + '}'
+    return _brackets('{', (yield node.elts) if values is None else list(map(repr, values)), '}', wrap)
+
+
+def _src_Dict(node, wrap=False, minify=False):
+    keys = None if None in node.keys else _constants(node.keys)
+    values = None if keys is None else _constants(node.values)
+    if values is not None and minify:
+        return '{' + ','.join(map(':'.join, zip(map(_short_repr, keys), map(_short_repr, values)))) + '}'
+    if values is not None:
+        return _brackets('{', list(map(':'.join, zip(map(repr, keys), map(repr, values)))), '}', wrap)
+    keys, values = (yield node.keys), (yield node.values)
+    # Create a list of all key=value and **value pairs in the node, then join them
+    return _brackets('{', ['**' + value if key is None else key + ':' + value for key, value in zip(keys, values)], '}',
+                     wrap)
 
 
 def _src_Ellipsis(node): return '...'
@@ -87,14 +228,16 @@ def _src_NameConstant(const): return repr(const.value)
 def _src_Name(name): return name.id
 
 
-def _src_Starred(node): return '*' + to_source(node.value)
+def _src_Starred(node): return '*' + (yield node.value)
 
 
-# Mapping from AST operators to their priority/precedence. Higher numbers represent higher precedence.
-priority = {ast.Pow: 13, ast.UAdd: 12, ast.USub: 12, ast.Invert: 12, ast.Mult: 11, ast.MatMult: 11, ast.Div: 11,
-            ast.FloorDiv: 11, ast.Mod: 11, ast.Add: 10, ast.Sub: 10, ast.LShift: 9, ast.RShift: 9, ast.BitAnd: 8,
-            ast.BitXor: 7, ast.BitOr: 6, ast.In: 5, ast.NotIn: 5, ast.Is: 5, ast.IsNot: 5, ast.Lt: 5, ast.LtE: 5,
-            ast.Gt: 5, ast.GtE: 5, ast.NotEq: 5, ast.Eq: 5, ast.Compare: 5, ast.Not: 4, ast.And: 3, ast.Or: 2, None: -1}
+# Mapping from AST operators to their priority/precedence. Higher numbers represent higher precedence. Attributes,
+# subscripts and calls bind tighter than any operator, when an operator is their base.
+priority = {ast.Attribute: 14, ast.Subscript: 14, ast.Call: 14, ast.Pow: 13, ast.UAdd: 12, ast.USub: 12, ast.Invert: 12,
+            ast.Mult: 11, ast.MatMult: 11, ast.Div: 11, ast.FloorDiv: 11, ast.Mod: 11, ast.Add: 10, ast.Sub: 10,
+            ast.LShift: 9, ast.RShift: 9, ast.BitAnd: 8, ast.BitXor: 7, ast.BitOr: 6, ast.In: 5, ast.NotIn: 5,
+            ast.Is: 5, ast.IsNot: 5, ast.Lt: 5, ast.LtE: 5, ast.Gt: 5, ast.GtE: 5, ast.NotEq: 5, ast.Eq: 5,
+            ast.Compare: 5, ast.Not: 4, ast.And: 3, ast.Or: 2, None: -1}
 
 # Mapping from AST operators to the string representing that operator
 operator_map = {ast.UAdd: '+', ast.USub: '-', ast.Not: 'not ', ast.Invert: '~', ast.Add: '+', ast.Sub: '-',
@@ -105,40 +248,52 @@ operator_map = {ast.UAdd: '+', ast.USub: '-', ast.Not: 'not ', ast.Invert: '~',
 left_associative = {ast.Sub, ast.Div, ast.FloorDiv, ast.Mod, ast.LShift, ast.RShift}  # All left-associative operators
 
 
-def _src_Expr(node): return to_source(node.value)
+def _src_Expr(node, minify=False): return (yield _bare(node.value)) if minify else (yield node.value)
 
 
-def _src_Op(node, parent_op=None, descend=0):
-    op = node.__class__ if isinstance(node, ast.Compare) else node.op.__class__
+def _parens(op, parent_op, descend):
     # Parentheses are only needed when the parent priority is greater (>= for left-associative operators).
     # They are also needed for Compare operators whose parent is also a Compare.
     # They are NOT needed if the operator is a unary minus/add/invert whose parent is a power (i.e 2**-1).
-    parens = not (op in (ast.UAdd, ast.USub, ast.Invert) and parent_op == ast.Pow and descend == 1) \
+    return not (op in (ast.UAdd, ast.USub, ast.Invert) and parent_op == ast.Pow and descend == 1) \
         and (priority[parent_op] > priority[op] or op == ast.Compare == parent_op
              or op in left_associative and parent_op in left_associative and priority[parent_op] >= priority[op]
              and descend == 1)
+
+
+def _src_Op(node, parent_op=None, descend=0, wrap=False):
+    op = node.__class__ if isinstance(node, ast.Compare) else node.op.__class__
+    parens = _parens(op, parent_op, descend)
     if isinstance(node, ast.UnaryOp):
-        src = operator_map[op] + to_source(node.operand, op)
+        src = operator_map[op] + (yield node.operand, op, 0)
     elif isinstance(node, ast.BinOp):
-        src = to_source(node.left, op, -1) + operator_map[op] + to_source(node.right, op, 1)
+        left = yield node.left, op, -1
+        src = left + operator_map[op] + (yield node.right, op, 1)
     elif isinstance(node, ast.BoolOp):
-        src = operator_map[op].join(to_source(value, op) for value in node.values)
+        values = []
+        for value in node.values:
+            values.append((yield value, op, 0))
+        if wrap:  # Break lines before the operators. Without parentheses, only possible inside enclosing brackets
+            src = (_LINE + operator_map[op].lstrip()).join(values)
+            return '(' + _OPEN + src + _CLOSE + ')' if parens else _GROUP + src + _END
+        src = operator_map[op].join(values)
     else:  # Compare. Join together all the comparison operators with the values being compared
-        src = to_source(node.left, op) + \
-              ''.join(operator_map[cmp.__class__]+value
-                      for cmp, value in zip(node.ops, (to_source(cmp, op) for cmp in node.comparators)))
+        src = yield node.left, op, 0
+        for cmp, value in zip(node.ops, node.comparators):
+            src += operator_map[cmp.__class__] + (yield value, op, 0)
     return '(' + src + ')' if parens else src
 
 _src_UnaryOp = _src_BoolOp = _src_BinOp = _src_Compare = _src_Op
 
 
-def _src_Call(node):
+_has_starargs = 'starargs' in ast.Call._fields  # starargs and kwargs were removed in Python 3.5
+
+
+def _src_Call(node, wrap=False):
     norm, key, star, double = [], [], [], []
-    try:
-        starargs, kwargs = to_source(node.starargs), to_source(node.kwargs)
-    except AttributeError:  # starargs and kwargs were removed in Python 3.5
-        for arg in node.args + node.keywords:
-            exported = to_source(arg)
+    if not _has_starargs:
+        args = node.args + node.keywords
+        for arg, exported in zip(args, (yield args)):
             if isinstance(arg, ast.Starred):
                 star.append(exported)
             elif isinstance(arg, ast.keyword):
@@ -149,57 +304,64 @@ def _src_Call(node):
             else:
                 norm.append(exported)
     else:
-        norm = list(map(to_source, node.args))
-        key = list(map(to_source, node.keywords))
+        starargs, kwargs = (yield node.starargs), (yield node.kwargs)
+        norm = yield node.args
+        key = yield node.keywords
         star = ['*' + starargs] if starargs else []
         double = ['**' + kwargs] if kwargs else []
-    finally:
-        return to_source(node.func) + '(' + ', '.join(norm + key + star + double) + ')'
+    return (yield node.func) + _brackets('(', norm + key + star + double, ')', wrap)
 
 
-def _src_keyword(node): return ('**' if node.arg is None else node.arg + '=') + to_source(node.value)
+def _src_keyword(node): return ('**' if node.arg is None else node.arg + '=') + (yield node.value)
 
 
-def _src_IfExp(node): return to_source(node.body) + ' if ' + to_source(node.test) + ' else ' + to_source(node.orelse)
+def _src_IfExp(node):
+    body, test, orelse = (yield node.body), (yield node.test), (yield node.orelse)
+    return body + ' if ' + test + ' else ' + orelse
 
 
-def _src_Attribute(node): return to_source(node.value) + '.' + node.attr
+def _src_Attribute(node): return (yield node.value) + '.' + node.attr
 
 
-def _src_Subscript(node): return to_source(node.value) + '[' + to_source(node.slice) + ']'
+def _src_Subscript(node, minify=False):
+    value = yield node.value
+    return value + '[' + ((yield _bare(node.slice)) if minify else (yield node.slice)) + ']'
 
 
-def _src_Index(node): return to_source(node.value)
+def _src_Index(node): return (yield node.value)
 
 
 def _src_Slice(node):
-    lower, upper, step = to_source(node.lower), to_source(node.upper), to_source(node.step)
+    lower, upper, step = (yield node.lower), (yield node.upper), (yield node.step)
     lower, upper = lower if lower else '', upper if upper else ''
     return lower + ':' + upper + (':' + step if step else '')
 
 
-def _src_ExtSlice(node): return ', '.join(to_source(dim) for dim in node.dims)
+def _src_ExtSlice(node): return ', '.join((yield node.dims))
 
 
-def _src_ListComp(node):
-    return '[' + to_source(node.elt) + ' ' + ' '.join(to_source(gen) for gen in node.generators) + ']'
+def _src_ListComp(node, wrap=False):
+    elt = yield node.elt
+    return _brackets('[', [elt] + (yield node.generators), ']', wrap, ' ')
 
 
-def _src_SetComp(node):
-    return '{' + to_source(node.elt) + ' ' + ' '.join(to_source(gen) for gen in node.generators) + '}'
+def _src_SetComp(node, wrap=False):
+    elt = yield node.elt
+    return _brackets('{', [elt] + (yield node.generators), '}', wrap, ' ')
 
 
-def _src_GeneratorExp(node):
-    return '(' + to_source(node.elt) + ' ' + ' '.join(to_source(gen) for gen in node.generators) + ')'
+def _src_GeneratorExp(node, wrap=False):
+    elt = yield node.elt
+    return _brackets('(', [elt] + (yield node.generators), ')', wrap, ' ')
 
 
-def _src_DictComp(node):
-    key, value = to_source(node.key), to_source(node.value)
-    return '{' + key + ':' + value + ' ' + ' '.join(to_source(gen) for gen in node.generators) + '}'
+def _src_DictComp(node, wrap=False):
+    key, value = (yield node.key), (yield node.value)
+    return _brackets('{', [key + ':' + value] + (yield node.generators), '}', wrap, ' ')
 
 
 def _src_comprehension(node):
-    target, iter, ifs = to_source(node.target), to_source(node.iter), list(map(to_source, node.ifs))
+    target, iter, ifs = (yield node.target), (yield node.iter), (yield node.ifs)
     l = ['async'] if node.is_async else []
     l.extend(['for', target, 'in', iter])
     if ifs:
@@ -207,19 +369,29 @@ def _src_comprehension(node):
     return ' '.join(l)
 
 
-def _src_Assign(node): return ' = '.join(to_source(target) for target in node.targets) + ' = ' + to_source(node.value)
+def _src_Assign(node, minify=False):
+    if minify:
+        targets = []
+        for target in node.targets:
+            targets.append((yield _bare(target)))
+        return '='.join(targets) + '=' + (yield _bare(node.value))
+    targets = yield node.targets
+    return ' = '.join(targets) + ' = ' + (yield node.value)
 
 
 def _src_AnnAssign(node):
-    target, annotation, value = to_source(node.target), to_source(node.annotation), to_source(node.value)
+    target, annotation, value = (yield node.target), (yield node.annotation), (yield node.value)
     l = [target + ':' if node.simple == 1 else '(' + target + '):', annotation]
     if value is not None:
         l.extend(['=', value])
     return ' '.join(l)
 
 
-def _src_AugAssign(node):
-    return ' '.join([to_source(node.target), operator_map[node.op.__class__]+'=', to_source(node.value)])
+def _src_AugAssign(node, minify=False):
+    target = yield node.target
+    if minify:
+        return target + operator_map[node.op.__class__] + '=' + (yield _bare(node.value))
+    return ' '.join([target, operator_map[node.op.__class__]+'=', (yield node.value)])
 
 
 def _src_Print(node):  # TODO Python 2 only
@@ -227,27 +399,27 @@ def _src_Print(node):  # TODO Python 2 only
 
 
 def _src_Raise(node):
-    exc, cause = to_source(node.exc), to_source(node.cause)
+    exc, cause = (yield node.exc), (yield node.cause)
     return 'raise' + (' ' + exc if exc else '') + (' from ' + cause if cause else '')
 
 
 def _src_Assert(node):
-    test, msg = to_source(node.test), to_source(node.msg)
+    test, msg = (yield node.test), (yield node.msg)
     return 'assert ' + test + (', ' + msg if msg else '')
 
 
-def _src_Delete(node): return 'del ' + ', '.join(to_source(target) for target in node.targets)
+def _src_Delete(node): return 'del ' + ', '.join((yield node.targets))
 
 
 def _src_Pass(node): return 'pass'
 
 
-def _src_Import(node): return 'import ' + ', '.join(to_source(name) for name in node.names)
+def _src_Import(node): return 'import ' + ', '.join((yield node.names))
 
 
 def _src_ImportFrom(node):
     module = '.'*node.level + (node.module if node.module else '')
-    return 'from ' + module + ' import ' + ', '.join(to_source(name) for name in node.names)
+    return 'from ' + module + ' import ' + ', '.join((yield node.names))
 
 
 def _src_alias(node):
@@ -255,40 +427,33 @@ def _src_alias(node):
 
 
 def _src_If(node):
-    test = 'if ' + to_source(node.test) + ':'
-    body = list(indent(line_export(node.body)))
+    yield 'if ' + (yield node.test) + ':'
+    yield from _block(node.body)
+    # Render elif chains in place, rather than as nested Ifs
+    while len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
+        node = node.orelse[0]
+        yield 'elif ' + (yield node.test) + ':'
+        yield from _block(node.body)
     if node.orelse:
-        if len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
-            orelse = node.orelse[0]
-            else_lines = to_source(orelse).split('\n')
-            else_lines[0] = 'el' + else_lines[0]
-            return '\n'.join([test] + body + else_lines)
-        else:
-            else_lines = []
-            for else_node in node.orelse:
-                else_lines.extend(to_source(else_node).split('\n'))
-            orelse = list(indent(else_lines))
-            return '\n'.join([test] + body + ['else:'] + orelse)
-    else:
-        return '\n'.join([test] + body)
+        yield 'else:'
+        yield from _block(node.orelse)
 
 
-def _src_For(node):
-    body = list(indent(line_export(node.body)))
-    s = 'for ' + to_source(node.target) + ' in ' + to_source(node.iter) + ':'
+def _src_For(node, prefix='', minify=False):
+    target = (yield _bare(node.target)) if minify else (yield node.target)
+    yield prefix + 'for ' + target + ' in ' + (yield node.iter) + ':'
+    yield from _block(node.body)
     if node.orelse:
-        return '\n'.join([s] + body + ['else:'] + list(indent(line_export(node.orelse))))
-    else:
-        return '\n'.join([s] + body)
+        yield 'else:'
+        yield from _block(node.orelse)
 
 
 def _src_While(node):
-    body = list(indent(line_export(node.body)))
-    s = 'while ' + to_source(node.test) + ':'
+    yield 'while ' + (yield node.test) + ':'
+    yield from _block(node.body)
     if node.orelse:
-        return '\n'.join([s] + body + ['else:'] + list(indent(line_export(node.orelse))))
-    else:
-        return '\n'.join([s] + body)
+        yield 'else:'
+        yield from _block(node.orelse)
 
 
 def _src_Break(node): return 'break'
@@ -297,64 +462,57 @@ def _src_Break(node): return 'break'
 def _src_Continue(node): return 'continue'
 
 
-def line_export(nodes, indent=False): return (line for node in nodes for line in to_source(node).split('\n'))
-
-
-def indent(lines): return (' '*4 + line for line in lines)
-
-
 def _src_Try(node):
-    l = ['try:'] + list(indent(line_export(node.body)))
-    if node.handlers:
-        l.extend(line_export(node.handlers))
+    yield 'try:'
+    yield from _block(node.body)
+    yield from _block(node.handlers, indent=False)
     if node.orelse:
-        l.append('else:')
-        l.extend(indent(line_export(node.orelse)))
+        yield 'else:'
+        yield from _block(node.orelse)
     if node.finalbody:
-        l.append('finally:')
-        l.extend(indent(line_export(node.finalbody)))
-    return '\n'.join(l)
+        yield 'finally:'
+        yield from _block(node.finalbody)
 
 
 def _src_ExceptHandler(node):
-    type = to_source(node.type)
-    if to_source(node.type) is None:
+    type = yield node.type
+    if type is None:
         header = 'except:'
     elif node.name is None:
         header = 'except ' + type + ':'
     else:
         header = 'except ' + type + ' as ' + node.name + ':'
-    return '\n'.join([header] + list(indent(line_export(node.body))))
+    yield header
+    yield from _block(node.body)
 
 
-def _src_With(node):
-    l = ['with ' + ', '.join(to_source(item) for item in node.items) + ':'] + list(indent(line_export(node.body)))
-    return '\n'.join(l)
+def _src_With(node, prefix=''):
+    yield prefix + 'with ' + ', '.join((yield node.items)) + ':'
+    yield from _block(node.body)
 
 
 def _src_withitem(node):
-    context_expr, optional_vars = to_source(node.context_expr), to_source(node.optional_vars)
+    context_expr, optional_vars = (yield node.context_expr), (yield node.optional_vars)
     return context_expr if optional_vars is None else context_expr + ' as ' + optional_vars
 
 
-def _src_FunctionDef(node):  # TODO: Lots of compatibility before Python 3, 3.3
-    l = ['@' + to_source(decorator) for decorator in node.decorator_list]
-    return_annotation = ' -> ' + to_source(node.returns) if node.returns else ''
-    l.append('def ' + node.name + '(' + to_source(node.args) + ')' + return_annotation + ':')
-    return '\n'.join(l + list(indent(line_export(node.body))))
+def _src_FunctionDef(node, prefix=''):  # TODO: Lots of compatibility before Python 3, 3.3
+    for decorator in (yield node.decorator_list):
+        yield '@' + decorator
+    return_annotation = ' -> ' + (yield node.returns) if node.returns else ''
+    yield prefix + 'def ' + node.name + '(' + (yield node.args) + ')' + return_annotation + ':'
+    yield from _block(node.body)
 
 
 def _src_Lambda(node):
-    args, body = to_source(node.args), to_source(node.body)
+    args, body = (yield node.args), (yield node.body)
     return ('lambda ' + args if args else 'lambda') + ': ' + body
 
 
 def _src_arguments(arguments):
-    args = list(map(to_source, arguments.args))
-    kwonly = list(map(to_source, arguments.kwonlyargs))
-    vararg, kwarg = to_source(arguments.vararg), to_source(arguments.kwarg)
-    defaults = list(map(to_source, arguments.defaults))
-    kw_defaults = list(map(to_source, arguments.kw_defaults))
+    args, kwonly = (yield arguments.args), (yield arguments.kwonlyargs)
+    vararg, kwarg = (yield arguments.vararg), (yield arguments.kwarg)
+    defaults, kw_defaults = (yield arguments.defaults), (yield arguments.kw_defaults)
     defaults = [None]*(len(args)-len(defaults)) + defaults
     l = [arg + '=' + default if default is not None else arg for arg, default in zip(args, defaults)]
     if vararg is not None:
@@ -365,16 +523,19 @@ def _src_arguments(arguments):
     return ', '.join(l)
 
 
-def _src_arg(arg): return arg.arg + ': ' + to_source(arg.annotation) if arg.annotation else arg.arg
+def _src_arg(arg): return arg.arg + ': ' + (yield arg.annotation) if arg.annotation else arg.arg
 
 
-def _src_Return(node): return 'return ' + to_source(node.value) if node.value else 'return'
+def _src_Return(node, minify=False):
+    if not node.value:
+        return 'return'
+    return 'return ' + ((yield _bare(node.value)) if minify else (yield node.value))
 
 
-def _src_Yield(node): return 'yield ' + to_source(node.value)
+def _src_Yield(node): return 'yield ' + (yield node.value)
 
 
-def _src_YieldFrom(node): return 'yield from ' + to_source(node.value)
+def _src_YieldFrom(node): return 'yield from ' + (yield node.value)
 
 
 def _src_Global(node): return 'global ' + ', '.join(node.names)
@@ -384,63 +545,1580 @@ def _src_Nonlocal(node): return 'nonlocal ' + ', '.join(node.names)
 
 
 def _src_ClassDef(node):
-    l = ['@' + to_source(decorator) for decorator in node.decorator_list]
-    args = [to_source(base) for base in node.bases] + [to_source(keyword) for keyword in node.keywords]
-    l.append('class ' + node.name + ('(' + ', '.join(args) + '):' if args else ':'))
-    return '\n'.join(l + list(indent(line_export(node.body))))
+    for decorator in (yield node.decorator_list):
+        yield '@' + decorator
+    args = (yield node.bases) + (yield node.keywords)
+    yield 'class ' + node.name + ('(' + ', '.join(args) + '):' if args else ':')
+    yield from _block(node.body)
 
 
-def _src_AsyncFunctionDef(node): return 'async ' + _src_FunctionDef(node)
+def _src_AsyncFunctionDef(node): return (yield from _src_FunctionDef(node, prefix='async '))
 
 
-def _src_Await(node): return 'await ' + to_source(node.value)
+def _src_Await(node): return 'await ' + (yield node.value)
 
 
-def _src_AsyncFor(node): return 'async ' + _src_For(node)
+def _src_AsyncFor(node, minify=False): return (yield from _src_For(node, prefix='async ', minify=minify))
 
 
-def _src_AsyncWith(node): return 'async ' + _src_With(node)
+def _src_AsyncWith(node): return (yield from _src_With(node, prefix='async '))
 
 
-def _src_Expression(node): return to_source(node.body)
+def _src_Expression(node): return (yield node.body)
 
 # Maps AST classes to the functions used to turn them into source code
 mapping = {getattr(ast, name[5:]): obj for name, obj in globals().copy().items()
            if name.startswith('_src_') and callable(obj) and hasattr(ast, name[5:])}
 
 
-max_depth = 0
-def depth_counter(f):  # Depth counter for keeping track of recursion depth
-    depth = 0
-    def wrapper(*args, **kwargs):
+def _sequence(nodes, sources, pending, handlers):
+    # Finishes rendering a list of nodes, once to_source has found one that needs its own generator (pending)
+    sources.append((yield pending))
+    for node in nodes[len(sources):]:
+        if node is None:
+            sources.append(None)
+            continue
+        value = handlers[node.__class__](node)
+        sources.append((yield value) if value.__class__ is _generator else value)
+    return sources
+
+_generator = type(_sequence([], [], None, None))
+
+
+_hashed_fields = {}  # Maps AST classes to the fields that _signature hashes
+
+
+def _signature(node, memo):
+    # Hashes every node, field and value in a statement's subtree, so that any change to it changes the hash.
+    # The hashes of nested statements are stored in memo, and stand in for their subtrees in the hash of their parent
+    saved, l, stack = [], [], [node]
+    push = stack.append
+    while stack:
+        node = stack.pop()
+        if node.__class__ is tuple:  # The end of a statement's subtree
+            signature = memo[id(node[0])] = hash(tuple(l))
+            l = saved.pop()
+            l.append(signature)
+            continue
+        if isinstance(node, ast.stmt):
+            signature = memo.get(id(node))
+            if signature is not None:
+                l.append(signature)
+                continue
+            saved.append(l)
+            l = []
+            push((node,))
+        l.append(id(node))
+        fields = _hashed_fields.get(node.__class__)
+        if fields is None:  # Expression contexts never change the source
+            fields = _hashed_fields[node.__class__] = tuple(f for f in node._fields if f != 'ctx')
+        for field in fields:
+            value = getattr(node, field, None)
+            if isinstance(value, ast.AST):
+                push(value)
+            elif isinstance(value, list):
+                l.append(len(value))
+                for e in value:
+                    if isinstance(e, ast.AST):
+                        push(e)
+                    else:
+                        l.append(e)
+            else:  # Include the type, since e.g. True == 1 == 1.0
+                l.append(value)
+                l.append(value.__class__)
+    return l[0]
+
+
+class RenderCache:
+    """ Remembers the rendered source of statements across to_source calls on a tree that is being modified.
+
+    Pass the same cache to every to_source call (or to_source_stream/to_source_to_file) on the tree. Statements whose
+    subtrees are unchanged since they were last rendered are copied from the cache instead of being rendered again.
+    A cache can be shared by calls in different threads.
+
+    Args:
+        maxsize (int): The maximum number of statements to remember. The least recently used are evicted first.
+        check (bool): Whether to detect changes automatically, by checking the subtree of each statement before
+            reusing its source. If False, the cache relies entirely on invalidate() being called for changed statements.
+    """
+    def __init__(self, maxsize=4096, check=True):
+        self.maxsize, self.check = maxsize, check
+        self.hits = self.misses = 0
+        self._lock = threading.RLock()
+        # Maps id(statement) to [statement, signature, source, indentation, enclosing statement, handlers], where the
+        # source is either the line of a simple statement or a tuple of the lines of a block statement, at that
+        # indentation, and handlers is the table of source generators that rendered it
+        self._entries = collections.OrderedDict()
+
+    def __len__(self): return len(self._entries)
+
+    def invalidate(self, node):
+        """ Forgets the source of a statement, and of every cached statement enclosing it.
+
+        Args:
+            node: The statement that was changed.
+        """
+        with self._lock:
+            while node is not None:
+                entry = self._entries.get(id(node))
+                if entry is None or entry[0] is not node:
+                    return
+                del self._entries[id(node)]
+                node = entry[4]
+
+    def clear(self):
+        """ Forgets every cached statement. """
+        with self._lock:
+            self._entries.clear()
+
+    def _render(self, node, lines, prefix, active, memo, handlers):
+        # Returns the source of a cached simple statement, or writes out the lines of a cached block statement and
+        # returns None. Otherwise returns a generator that renders the statement and records its source
+        signature = _signature(node, memo) if self.check else None
+        with self._lock:
+            entry = self._entries.get(id(node))
+            hit = entry is not None and entry[0] is node and entry[1] == signature and entry[5] is handlers
+            if hit:
+                self.hits += 1
+                self._entries.move_to_end(id(node))
+            else:
+                self.misses += 1
+        if hit:
+            source, indent = entry[2], entry[3]
+            if source.__class__ is str:
+                return source
+            if indent == len(prefix):
+                lines.extend(source)
+            else:
+                lines.extend([prefix + line[indent:] for line in source])
+            return None
+        value = handlers[node.__class__](node)
+        return self._record(node, value, signature, lines, len(prefix), active, handlers) \
+            if value.__class__ is _generator else value
+
+    def _record(self, node, gen, signature, lines, indent, active, handlers):
+        parent = active[-1] if active else None
+        start = len(lines)
+        active.append(node)
+        value = yield from gen
+        active.pop()
+        source = tuple(lines[start:]) if value is None else value  # Block statements write their lines instead
+        with self._lock:
+            self._entries[id(node)] = [node, signature, source, indent, parent, handlers]
+            self._entries.move_to_end(id(node))
+            while len(self._entries) > self.maxsize:
+                # Evicting a statement also evicts the statements enclosing it, so that invalidate can always find them
+                self.invalidate(next(iter(self._entries.values()))[0])
+        return value
+
+
+_newline = re.compile('\r\n|\r|\n')  # The line endings recognized by the tokenizer
+
+
+def _location(node):  # The position of a node in its source, or None if it doesn't have one
+    end_col_offset = getattr(node, 'end_col_offset', None)  # Only available from Python 3.8
+    return None if end_col_offset is None else \
+        (node.__class__, node.lineno, node.col_offset, node.end_lineno, end_col_offset)
+
+
+_block_types = (ast.stmt, ast.excepthandler, getattr(ast, 'match_case', ast.stmt))
+
+
+def _blocks(node):
+    # Splits the fields of a statement into the values of fields that don't hold statements, and the lists of nested
+    # statements (or except handlers and match cases, which hold statements in turn)
+    fields, blocks = [], []
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if value.__class__ is list and value and isinstance(value[0], _block_types):
+            blocks.append(value)
+        else:
+            fields.append(value)
+    return fields, blocks
+
+
+def _slice(line, start, end):  # Column offsets in the AST are in UTF-8 bytes
+    encoded = line.encode('utf-8')
+    return line[start:end] if len(encoded) == len(line) else encoded[start:end].decode('utf-8')
+
+
+class _SourcePatcher:
+    """ Stands in for a RenderCache, copying statements that are unchanged from the source they were parsed from. """
+    def __init__(self, source, module=None):
+        self.lines = _newline.split(source)
+        self.module = module if module is not None else ast.parse(source)
+        # Maps the location of each statement in the source to it and the statements before and after it in its block
+        self.statements, blocks = {}, [self.module.body]
+        while blocks:
+            block = blocks.pop()
+            for i, statement in enumerate(block):
+                if isinstance(statement, ast.stmt):
+                    self.statements[_location(statement)] = (statement, block[i-1] if i else None,
+                                                             block[i+1] if i+1 < len(block) else None)
+                blocks.extend(_blocks(statement)[1])
+        self.statements.pop(None, None)
+        self.unchanged = {}  # Maps pairs of ids of modified and original statements to whether they are the same
+        # The first and last statements written, where copying the last one stopped, the statement following it and
+        # the number of lines written by then, so that statements that were adjacent in the source can be copied along
+        # with whatever was between
+        self.first = self.last = self.stop = self.next = self.output = None
+        self.end = -1
+
+    def text(self, start_line, start_col, end_line, end_col):  # Returns the lines of the source between two positions
+        lines = self.lines
+        if start_line == end_line:
+            return [_slice(lines[start_line-1], start_col, end_col)]
+        return [_slice(lines[start_line-1], start_col, None)] + lines[start_line:end_line-1] + \
+            [_slice(lines[end_line-1], 0, end_col)]
+
+    def same(self, node, original):
+        # Compares two statements. The statements nested in them are compared separately, and the results remembered,
+        # so that when a block statement has changed, comparing the statements in it doesn't compare any node twice.
+        # Statements shared with the original tree are the same without comparing them
+        unchanged, stack = self.unchanged, [(node, original, None)]
+        while stack:
+            node, original, blocks = stack.pop()
+            if blocks is not None:  # All nested statements have been compared
+                unchanged[id(node), id(original)] = all(unchanged[id(n), id(o)] for n, o in blocks)
+                continue
+            if (id(node), id(original)) in unchanged:
+                continue
+            if node is original:
+                unchanged[id(node), id(original)] = True
+                continue
+            fields, blocks = _blocks(node)
+            other_fields, other_blocks = _blocks(original)
+            if node.__class__ is not original.__class__ or list(map(len, blocks)) != list(map(len, other_blocks)) or \
+                    not all(compare_ast(v1, v2) for v1, v2 in zip(fields, other_fields)):
+                unchanged[id(node), id(original)] = False
+                continue
+            blocks = [pair for b1, b2 in zip(blocks, other_blocks) for pair in zip(b1, b2)]
+            stack.append((node, original, blocks))
+            stack.extend((n, o, None) for n, o in blocks)
+        return unchanged[id(node), id(original)]
+
+    def _render(self, node, lines, prefix, active, memo, handlers):
+        entry = self.statements.get(_location(node))
+        if entry is None:
+            return handlers[node.__class__](node)
+        original, preceding, following = entry
+        decorators = getattr(original, 'decorator_list', None)
+        start_line, start_col = decorators[0].lineno if decorators else original.lineno, original.col_offset
+        indentation = _slice(self.lines[start_line-1], 0, start_col)
+        # Statements can only be copied at the same indentation they had, unless they followed a semicolon
+        if indentation != prefix and not indentation.strip():
+            return handlers[node.__class__](node)
+        if not lines:
+            self.first = original
+        adjacent = original is self.next and self.end == len(lines)
+        same = self.same(node, original)
+        if adjacent and (same or start_line > self.stop[0]):  # Keep whatever was between it and the last statement
+            text = self.text(self.stop[0], self.stop[1], start_line, start_col)
+            lines[-1] += text[0]
+            lines.extend(text[1:-1])
+        elif preceding is not None and start_line > preceding.end_lineno + 1:
+            # Keep the comments and blank lines between it and the statement before it in the source
+            lines.extend(self.lines[preceding.end_lineno:start_line-1])
+        if same:
+            end_line, end_col = original.end_lineno, original.end_col_offset
+            line = self.lines[end_line-1]
+            if _slice(line, end_col, None).lstrip().startswith('#'):  # Keep a comment following it
+                end_col = len(line.encode('utf-8'))
+            text = self.text(start_line, start_col, end_line, end_col)
+            if adjacent and start_line == self.stop[0]:  # Following a semicolon
+                lines[-1] += text[0]
+            else:
+                lines.append(prefix + text[0])
+            lines.extend(text[1:])
+            self.last, self.next, self.end, self.output = original, following, len(lines), lines
+            self.stop = end_line, end_col
+            return None
+        return self._record(handlers[node.__class__](node), original, following, lines)
+
+    def _record(self, value, original, following, lines):
+        # Renders a changed statement, then records where it ended so that what followed it can be copied too
+        if value.__class__ is _generator:
+            value = yield from value
+        if value is not None:  # Simple statements are returned rather than emitted
+            yield value
+        self.last, self.next, self.end, self.output = original, following, len(lines), lines
+        self.stop = original.end_lineno, original.end_col_offset
+
+
+def _layout(line, width, measure=len):
+    """ Breaks the groups of a rendered line across as many lines as needed to fit them within a width.
+
+    A group is kept on one line if it fits, along with whatever follows it up to the next place a line could break, and
+    is broken otherwise, placing each item on its own line one level deeper than the line it started on. Boolean chains
+    can only be broken inside an enclosing group that was. Groups are laid out in two linear passes, the first measuring
+    each group and the second deciding whether it fits, so huge expressions are laid out in linear time. measure gives
+    the length of text as it will be written out.
+    """
+    parts = _markers.split(line)  # Alternates between text and markers
+    # The first pass finds where each group ends and its length on one line, and how much text follows each part up to
+    # the next place a line could break
+    ends, sizes, starts, column = {}, {}, [], 0
+    for i in range(1, len(parts), 2):
+        column += measure(parts[i-1])
+        marker = parts[i]
+        if marker == _LINE:
+            column += 1
+        elif marker == _OPEN or marker == _GROUP:
+            starts.append((i, column))
+        else:
+            start, start_column = starts.pop()
+            ends[start], sizes[start] = i, column - start_column
+    following, after = [0] * (len(parts) + 1), 0
+    for i in range(len(parts) - 1, -1, -1):
+        part = parts[i]
+        if i % 2 == 0:
+            after += measure(part)
+        elif part == _LINE or part == _CLOSE:
+            after = 0
+        following[i] = after
+    # The second pass writes out the line, breaking the groups that don't fit
+    indent = len(line) - len(line.lstrip(' '))
+    out, groups, column = [], [], 0  # Whether each enclosing group is broken, and the indentation outside it
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            out.append(part)
+            column += measure(part)
+        elif part == _LINE:
+            if groups[-1][0]:
+                out.append('\n' + ' ' * indent)
+                column = indent
+            else:
+                out.append(' ')
+                column += 1
+        elif part == _OPEN or part == _GROUP:
+            # Groups inside groups kept on one line are too, and boolean chains can't break outside of any brackets
+            breakable = groups[-1][0] if groups else part == _OPEN
+            broken = breakable and column + sizes[i] + following[ends[i] + 1] > width
+            groups.append((broken, indent))
+            if broken:
+                indent += 4
+                if part == _OPEN:
+                    out.append('\n' + ' ' * indent)
+                    column = indent
+        else:
+            broken, outer = groups.pop()
+            if broken:
+                indent = outer
+                if part == _CLOSE:
+                    out.append('\n' + ' ' * indent)
+                    column = indent
+    return ''.join(out)
+
+
+def _wrap_lines(source, width, measure=len):  # Lays out every line of rendered source that doesn't fit within a width
+    lines = source.split('\n')
+    for i, line in enumerate(lines):
+        flat = line.translate(_flat)
+        if measure(flat) > width and len(flat) != len(line):  # Every line with a group has at least two markers removed
+            flat = _layout(line, width, measure)
+        lines[i] = flat
+    return '\n'.join(lines)
+
+
+# String literals, which minifying leaves untouched while dropping optional whitespace from the rest of the source
+_literals = re.compile(r"""('[^'\\\n]*(?:\\.[^'\\\n]*)*'|"[^"\\\n]*(?:\\.[^"\\\n]*)*")""")
+
+
+def _minify(source):
+    # Drops optional whitespace, indents blocks by a single space, and joins simple statements with ; onto a single
+    # line, or onto the line of the block statement they're the body of
+    parts = _literals.split(source)
+    for i in range(0, len(parts), 2):
+        parts[i] = parts[i].replace(', ', ',').replace(': ', ':').replace(' = ', '=').replace(' -> ', '->')
+    lines, result = ''.join(parts).split('\n'), []
+    levels = [(len(line) - len(line.lstrip(' '))) // 4 for line in lines]
+    simple = False  # Whether the last line written ends with a simple statement that another can be joined onto
+    i = 0
+    while i < len(lines):
+        level, line = levels[i], lines[i].lstrip(' ')
+        if line.endswith(':'):  # A block statement, joined with its body if it's only simple statements
+            j = i + 1
+            while j < len(lines) and levels[j] > level:
+                j += 1
+            body = [statement.lstrip(' ') for statement in lines[i+1:j]]
+            if j > i + 1 and max(levels[i+1:j]) == level + 1 and \
+                    not any(statement.endswith(':') or statement.startswith('@') for statement in body):
+                line += ';'.join(body)
+                i = j - 1
+            result.append(' '*level + line)
+            simple = False
+        elif simple and level == levels[i-1] and not line.startswith('@'):
+            result[-1] += ';' + line
+        else:
+            result.append(' '*level + line)
+            simple = not line.startswith('@')
+        i += 1
+    return '\n'.join(result)
+
+
+max_depth = 0  # Deepest nesting of source generators reached by to_source
+_max_depth_lock = threading.Lock()
+
+_operators = (ast.UnaryOp, ast.BinOp, ast.BoolOp, ast.Compare)  # Rendered in the context of their parent operator
+# Nodes that are rendered as groups when wrapping long lines
+_wrapped = (ast.List, ast.Tuple, ast.Set, ast.Dict, ast.Call, ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp,
+            ast.BoolOp)
+# Nodes rendered differently when minifying, dropping optional parentheses around tuples and shortening constants.
+# (AsyncFor was added in Python 3.5, and Constant in 3.6)
+_minified = (ast.Expr, ast.Assign, ast.AugAssign, ast.Return, ast.For, ast.Subscript, ast.List, ast.Tuple, ast.Set,
+             ast.Dict) + tuple(cls for cls in (getattr(ast, 'AsyncFor', None), _Constant) if cls is not None)
+
+
+class _Recorder:
+    """ The statistics recorded for a Profile by one thread. """
+    def __init__(self):
+        # Maps AST classes to [calls, cumulative seconds, self seconds, characters of source produced]
+        self.entries = {}
+        self.max_depth = 0  # Deepest nesting of source generators reached
+        self.tables = {}  # Maps ids of handler tables to them and the same tables with each handler timed
+        self.children = [[0.0, 0]]  # The time taken by and source received from the children of each active node
+
+    def wrap(self, handlers):  # Returns a copy of a table of handlers, with every handler timed
+        table = self.tables.get(id(handlers))
+        if table is None or table[0] is not handlers:
+            table = self.tables[id(handlers)] = (handlers, {cls: self.timer(cls, func) for cls, func in
+                                                           handlers.items()})
+        return table[1]
+
+    def timer(self, cls, func):
+        entries, children, clock = self.entries, self.children, time.perf_counter
+
+        def timed(node, *args):
+            entry = entries.get(cls)
+            if entry is None:
+                entry = entries[cls] = [0, 0.0, 0.0, 0]
+            start = clock()
+            value = func(node, *args)
+            if value.__class__ is _generator:
+                children.append([0.0, 0])
+                return self.timed(value, entry, start)
+            elapsed = clock() - start
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += elapsed
+            size = len(value) if value.__class__ is str else 0
+            entry[3] += size
+            parent = children[-1]
+            parent[0] += elapsed
+            parent[1] += size
+            return value
+        return timed
+
+    def timed(self, generator, entry, start):
+        # Drives a source generator on behalf of to_source, counting the characters of the lines it writes
+        send, value, produced, clock = generator.send, None, 0, time.perf_counter
+        while True:
+            try:
+                request = send(value)
+            except StopIteration as stop:
+                value = stop.value
+                break
+            if request.__class__ is str:
+                produced += len(request)
+            value = yield request
+        returned = len(value) if value.__class__ is str else 0  # Block statements write their lines instead
+        elapsed = clock() - start
+        children, received = self.children.pop()
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += elapsed - children
+        entry[3] += produced + returned - received
+        parent = self.children[-1]
+        parent[0] += elapsed
+        parent[1] += returned
+        return value
+
+
+class Profile:
+    """ Records how much time rendering each type of node takes, when passed to to_source.
+
+    Each type of node is attributed the time spent in its source generator, and the characters of source it produced
+    itself, excluding the source of its children. The same profile can be passed to several calls to add up their
+    statistics, including calls in different threads at the same time. Rendering without a profile isn't slowed down
+    at all.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._recorders, self._lock = [], threading.Lock()  # The recorders of every thread that used the profile
+
+    def _recorder(self):  # The recorder of the current thread
+        recorder = getattr(self._local, 'recorder', None)
+        if recorder is None:
+            recorder = self._local.recorder = _Recorder()
+            with self._lock:
+                self._recorders.append(recorder)
+        return recorder
+
+    @property
+    def entries(self):
+        """ dict: Maps AST classes to [calls, cumulative seconds, self seconds, characters of source produced]. """
+        entries = {}
+        with self._lock:
+            recorders = list(self._recorders)
+        for recorder in recorders:
+            for cls, entry in list(recorder.entries.items()):
+                total = entries.setdefault(cls, [0, 0.0, 0.0, 0])
+                for i, value in enumerate(entry):
+                    total[i] += value
+        return entries
+
+    @property
+    def max_depth(self):
+        """ int: The deepest nesting of source generators reached. """
+        with self._lock:
+            return max([recorder.max_depth for recorder in self._recorders], default=0)
+
+    def clear(self):
+        """ Forgets all recorded statistics. """
+        with self._lock:
+            for recorder in self._recorders:
+                recorder.entries.clear()
+                recorder.max_depth = 0
+
+    def stats(self):
+        """ Returns the recorded statistics of each type of node.
+
+        Returns: list: (name, calls, cumulative seconds, self seconds, characters) tuples, by descending self time.
+        """
+        return sorted(((cls.__name__,) + tuple(entry) for cls, entry in self.entries.items()), key=lambda t: -t[3])
+
+    def __str__(self):
+        lines = ['{:<20} {:>10} {:>12} {:>12} {:>12}'.format('node', 'calls', 'cumulative', 'self', 'characters')]
+        for name, calls, cumulative, own, size in self.stats():
+            lines.append('{:<20} {:>10} {:>12.6f} {:>12.6f} {:>12}'.format(name, calls, cumulative, own, size))
+        return '\n'.join(lines)
+
+
+def _unmarked(text):  # The length of text once the markers of a SourceMap are removed from it
+    return len(_positions.sub('', text)) if _START in text or _STOP in text else len(text)
+
+
+def _marked(nodes, func, mark):
+    # Wraps a handler so that the source it renders is marked with the index of its node in nodes, by mark if the
+    # handler is a source generator
+    def marked(node, *args):
+        i = len(nodes)
+        nodes.append(node)
+        value = func(node, *args)
+        if value.__class__ is _generator:
+            return mark(value, i)
+        return _START + str(i) + _MARK + value + _STOP if value else value
+    return marked
+
+
+def _mark(generator, i):
+    value = yield from generator
+    return _START + str(i) + _MARK + value + _STOP if value else value
+
+
+def _marked_op(nodes, func):
+    # Wraps the built-in handler of an operator, marking its source inside the parentheses it may be rendered in
+    def marked(node, parent_op=None, descend=0):
+        i = len(nodes)
+        nodes.append(node)
+        op = node.__class__ if isinstance(node, ast.Compare) else node.op.__class__
+        return (_mark_parenthesized if _parens(op, parent_op, descend) else _mark)(func(node, parent_op, descend), i)
+    return marked
+
+
+def _mark_parenthesized(generator, i):
+    value = yield from generator
+    n = 2 if value.startswith('(' + _OPEN) else 1  # Wrapped boolean chains break lines inside their parentheses
+    return value[:n] + _START + str(i) + _MARK + value[n:-n] + _STOP + value[-n:]
+
+
+def _mark_block(generator, i):
+    # Marks the header of a block statement, which follows its decorators, and writes a line ending it after its body
+    send, value, start = generator.send, None, _START + str(i) + _MARK
+    while True:
+        try:
+            request = send(value)
+        except StopIteration as stop:
+            value = stop.value
+            break
+        if start is not None and request.__class__ is str and not request.startswith('@'):
+            request, start = start + request, None
+        value = yield request
+    yield _STOP
+    return value
+
+
+def _mark_module(generator, i):
+    yield _START + str(i) + _MARK
+    value = yield from generator
+    yield _STOP
+    return value
+
+
+class SourceMap:
+    """ Records where each node was written in the source code returned by to_source, when passed to it.
+
+    Positions are (lineno, col_offset, end_lineno, end_col_offset) tuples like the location attributes of AST nodes,
+    with lines counted from 1 and columns in UTF-8 bytes. They're recorded while rendering, so the source doesn't have
+    to be parsed again, and kept in a flat array rather than as a tuple per node. Nodes rendered as part of their
+    parent, like the elements of literals of constants or elif branches, have no position of their own. Each call to
+    to_source replaces the positions recorded by the last.
+    """
+    def __init__(self):
+        self.nodes = []  # Every node rendered, in the order they were rendered
+        self.positions = array.array('l')  # Four values for each node, all 0 if it has no position
+        self._index = None  # Maps ids of nodes to their index, built when first needed
+
+    def _wrap(self, handlers, op_handlers, builtin=()):
+        # Starts recording, returning the handler tables to render with. builtin holds the operators rendered by
+        # their built-in handlers, which add any parentheses they need themselves
+        self.nodes, self.positions, self._index = [], array.array('l'), None
+        table = {cls: _marked(self.nodes, func, _mark_module if issubclass(cls, (ast.Module, ast.Interactive)) else
+                              _mark_block if issubclass(cls, _block_types) and 'body' in cls._fields else _mark)
+                 for cls, func in handlers.items()}
+        for cls in builtin:
+            table[cls] = _marked_op(self.nodes, handlers[cls])
+        return table, {cls: table[cls] for cls in op_handlers}
+
+    def _locate(self, source):
+        # Finds the position of every marker in rendered source, and returns the source without them
+        positions = self.positions = array.array('l', [0]) * (4 * len(self.nodes))
+        lines, starts, pending = [], [], []  # pending holds the nodes starting on the next line with any text
+        last = (1, 0)  # The end of the last line with any text
+        for line in source.split('\n'):
+            if _START not in line and _STOP not in line:
+                parts = [line]
+            else:
+                parts = _positions.split(line)  # Alternates between text and the indices of _START markers
+                if not ''.join(parts[::2]).strip(' '):  # Markers of a block statement, on a line of their own
+                    for i in parts[1::2]:
+                        if i is not None:
+                            starts.append(int(i))
+                            pending.append(int(i))
+                            continue
+                        i = starts.pop()
+                        if pending and pending[-1] == i:  # Nothing was written between its markers
+                            pending.pop()
+                            positions[4*i:4*i+2] = array.array('l', last)
+                        positions[4*i+2:4*i+4] = array.array('l', last)
+                    continue
+            lineno, column, ascii = len(lines) + 1, 0, len(line) == len(line.encode('utf-8'))
+            for i in pending:
+                positions[4*i] = lineno
+                positions[4*i+1] = len(line) - len(line.lstrip(' '))
+            del pending[:]
+            for j, part in enumerate(parts):
+                if j % 2 == 0:
+                    column += len(part) if ascii else len(part.encode('utf-8'))
+                elif part is not None:
+                    i = int(part)
+                    starts.append(i)
+                    positions[4*i] = lineno
+                    positions[4*i+1] = column
+                else:
+                    i = starts.pop()
+                    positions[4*i+2] = lineno
+                    positions[4*i+3] = column
+            lines.append(''.join(parts[::2]) if len(parts) > 1 else line)
+            last = (lineno, column)
+        for i in pending:  # Nothing followed them
+            positions[4*i:4*i+2] = array.array('l', last)
+        return '\n'.join(lines)
+
+    def __len__(self): return sum(1 for i in range(0, len(self.positions), 4) if self.positions[i])
+
+    def __iter__(self):
+        """ Yields each node with a position, and its position. """
+        positions = self.positions
+        for i, node in enumerate(self.nodes):
+            if positions[4*i]:
+                yield node, tuple(positions[4*i:4*i+4])
+
+    def __contains__(self, node): return self.get(node) is not None
+
+    def __getitem__(self, node):
+        position = self.get(node)
+        if position is None:
+            raise KeyError(node)
+        return position
+
+    def get(self, node, default=None):
+        """ Returns the position of a node, or default if it has none. """
+        if self._index is None:
+            self._index = {id(node): i for i, node in enumerate(self.nodes)}
+        i = self._index.get(id(node))
+        if i is None or not self.positions[4*i]:
+            return default
+        return tuple(self.positions[4*i:4*i+4])
+
+    def apply(self):
+        """ Sets the location attributes of every node rendered to where it was written, so that the source code and
+        nodes compiled from the tree agree. Nodes without a position of their own are given that of their parent.
+        """
+        if not self.nodes:
+            return
+        stack = [(self.nodes[0], None)]
+        while stack:
+            node, position = stack.pop()
+            position = self.get(node, position)
+            if position is not None and 'lineno' in node._attributes:
+                node.lineno, node.col_offset, node.end_lineno, node.end_col_offset = position
+            stack.extend((child, position) for child in ast.iter_child_nodes(node))
+
+
+class SourceGenerator:
+    """ Converts AST nodes into source code, with a table of source generators built once per instance.
+
+    Subclasses can change how a type of node is rendered by defining a method named src_ followed by the name of its
+    AST class, such as src_Name(self, node). Like the built-in source generators, a method may return the source of
+    the node, or be a generator that yields child nodes (or lists of them) and is sent back their source. Methods for
+    UnaryOp, BinOp, BoolOp and Compare nodes are also passed the parent operator and which side of it the node is on.
+    The source of a statement may span several lines, each of which is indented to match the block it's in.
+    Overridden methods are used as they are when wrapping long lines, so the nodes they render are never broken.
+    """
+    def __init__(self):
+        self.handlers = dict(mapping)  # Maps AST classes to the functions used to turn them into source code
+        for name in dir(self.__class__):
+            if name.startswith('src_') and isinstance(getattr(ast, name[4:], None), type):
+                self.handlers[getattr(ast, name[4:])] = getattr(self, name)
+        # The handlers of operator nodes, which take the parent operator and side as well
+        self.op_handlers = {cls: self.handlers[cls] for cls in _operators}
+        self._builtin_operators = [cls for cls in _operators if self.handlers[cls] is mapping[cls]]
+        # The same tables for wrapping long lines, where the built-in handlers of some nodes render them as groups
+        self.wrapping_handlers = dict(self.handlers)
+        for cls in _wrapped:
+            if self.handlers[cls] is mapping[cls]:
+                self.wrapping_handlers[cls] = functools.partial(mapping[cls], wrap=True)
+        self.wrapping_op_handlers = {cls: self.wrapping_handlers[cls] for cls in _operators}
+        # And for minifying, where some drop the parentheses around tuples
+        self.minified_handlers = dict(self.handlers)
+        for cls in _minified:
+            if self.handlers[cls] is mapping[cls]:
+                self.minified_handlers[cls] = functools.partial(mapping[cls], minify=True)
+
+    def to_source(self, node, parent_op=None, descend=0, cache=None, profile=None, max_line_length=None,
+                  source_map=None, minify=False):
+        """ Converts an AST node into source code.
+
+        Args:
+            node: Any AST node derived from ast.AST.
+            cache (RenderCache): If given, reuses the source of statements that were unchanged since they were last
+                rendered with this cache.
+            profile (Profile): If given, records how much time rendering each type of node takes.
+            max_line_length (int): If given, breaks calls, collections, comprehensions and boolean chains across lines
+                where needed to keep lines within this length. Lines may still be longer where nothing can be broken.
+            source_map (SourceMap): If given, records where each node was written in the source code. cache isn't
+                used when recording positions, since every node has to be rendered again.
+            minify (bool): Whether to produce the smallest source code, dropping optional whitespace and parentheses,
+                indenting by a single space, joining simple statements with ; and shortening floats. Can't be combined
+                with max_line_length or source_map.
+
+        Returns: str: A string containing the source code corresponding to the AST.
+        """
         global max_depth
-        nonlocal depth
-        depth += 1
+        if node is None:
+            return None
+        if minify:
+            if max_line_length is not None or source_map is not None:
+                raise ValueError("minified source can't be wrapped or mapped")
+            handlers, op_handlers = self.minified_handlers, self.op_handlers
+        else:
+            handlers, op_handlers = (self.handlers, self.op_handlers) if max_line_length is None else \
+                (self.wrapping_handlers, self.wrapping_op_handlers)
+        if profile is not None:
+            recorder = profile._recorder()
+            children = len(recorder.children)
+            handlers, op_handlers = recorder.wrap(handlers), recorder.wrap(op_handlers)
+        if source_map is not None:
+            handlers, op_handlers = source_map._wrap(handlers, op_handlers, self._builtin_operators)
+            cache = None
+        if profile is None:
+            source, depth = self._render(node, parent_op, descend, cache, handlers, op_handlers)
+        else:
+            try:
+                source, depth = self._render(node, parent_op, descend, cache, handlers, op_handlers)
+            finally:
+                del recorder.children[children:]  # Left over if rendering failed
+            if depth > recorder.max_depth:
+                recorder.max_depth = depth
         if depth > max_depth:
-            max_depth = depth
-        rtn = f(*args, **kwargs)
-        depth -= 1
-        return rtn
-    return wrapper
+            with _max_depth_lock:
+                max_depth = max(max_depth, depth)
+        if max_line_length is not None:
+            source = _wrap_lines(source, max_line_length, len if source_map is None else _unmarked)
+        elif minify:
+            source = _minify(source)
+        return source if source_map is None else source_map._locate(source)
+
+    def _render(self, node, parent_op, descend, cache, handlers, op_handlers):
+        # Returns the source of a node, and the deepest nesting of source generators reached. All the state of a call
+        # is kept in local variables, so that any number of threads can render at once
+        lines, active, memo = [], [], {}  # active and memo hold the state of cache for this call
+        if cache is not None and isinstance(node, ast.stmt):
+            value = cache._render(node, lines, '', active, memo, handlers)
+        else:
+            func = op_handlers.get(node.__class__)
+            value = handlers[node.__class__](node) if func is None else func(node, parent_op, descend)
+        if value.__class__ is not _generator:
+            return '\n'.join(lines) if value is None else value, 0
+        # Drive the source generators with an explicit stack of suspended generators, so that rendering deeply nested
+        # trees uses constant Python stack space. The generator on top of the stack is resumed with the source of the
+        # last node it requested, until it yields another request or finishes.
+        stack, generator, sequence = [], _generator, _sequence
+        push, pop = stack.append, stack.pop
+        level, prefix = 0, ''
+        emit = lines.append
+        send, value, depth = value.send, None, 1
+        while True:
+            try:
+                request = send(value)
+            except StopIteration as stop:
+                value = stop.value
+                if not stack:
+                    break
+                send = pop()
+                continue
+            cls = request.__class__
+            if cls is tuple:  # Operand of an operator
+                child, op, child_descend = request
+                if child is None:
+                    value = None
+                    continue
+                func = op_handlers.get(child.__class__)
+                value = handlers[child.__class__](child) if func is None else func(child, op, child_descend)
+            elif cls is list:  # Render leaves inline, only falling back to _sequence once a generator is needed
+                sources = []
+                for child in request:
+                    if child is None:
+                        sources.append(None)
+                        continue
+                    value = handlers[child.__class__](child)
+                    if value.__class__ is generator:
+                        value = sequence(request, sources, value, handlers)
+                        break
+                    sources.append(value)
+                else:
+                    value = sources
+                    continue
+            elif cls is generator:  # Created by _sequence or _bare
+                value = request
+            elif cls is str:  # Line of a block statement, written once at the current indentation
+                if '\n' in request:  # Several lines, returned by an overridden method, are each indented
+                    lines.extend([prefix + line if line else line for line in request.split('\n')])
+                else:
+                    emit(prefix + request)
+                value = None
+                continue
+            elif cls is int:  # _INDENT or _DEDENT
+                level += request
+                prefix = ' '*4*level
+                value = None
+                continue
+            elif request is None:
+                value = None
+                continue
+            elif cache is not None and isinstance(request, ast.stmt):
+                value = cache._render(request, lines, prefix, active, memo, handlers)
+                if value is None:
+                    continue
+            else:
+                value = handlers[cls](request)
+            if value.__class__ is generator:
+                push(send)
+                send, value = value.send, None
+                if len(stack) >= depth:
+                    depth = len(stack) + 1
+        return '\n'.join(lines) if value is None else value, depth
+
 
+_default_generator = SourceGenerator()
 
-@depth_counter
-def to_source(node, parent_op=None, descend=0):
+
+def to_source(node, parent_op=None, descend=0, cache=None, profile=None, max_line_length=None, source_map=None,
+              minify=False):
     """ Converts an AST node into source code.
 
     Args:
         node: Any AST node derived from ast.AST.
+        cache (RenderCache): If given, reuses the source of statements that were unchanged since they were last
+            rendered with this cache.
+        profile (Profile): If given, records how much time rendering each type of node takes.
+        max_line_length (int): If given, breaks calls, collections, comprehensions and boolean chains across lines
+            where needed to keep lines within this length. Lines may still be longer where nothing can be broken.
+        source_map (SourceMap): If given, records where each node was written in the source code.
+        minify (bool): Whether to produce the smallest source code, dropping optional whitespace and parentheses,
+            indenting by a single space, joining simple statements with ; and shortening floats.
 
     Returns: str: A string containing the source code corresponding to the AST.
     """
-    if node is None:
-        return None
-    func = mapping[node.__class__]
-    if func in (_src_UnaryOp, _src_BinOp, _src_BoolOp, _src_Compare):
-        rtn = func(node, parent_op, descend)
-    else:
-        rtn = func(node)
-    return rtn
+    return _default_generator.to_source(node, parent_op, descend, cache, profile, max_line_length, source_map, minify)
+
+
+def to_source_stream(node, cache=None, profile=None, max_line_length=None, minify=False, generator=None):
+    """ Converts an AST node into source code, one chunk at a time.
+
+    Modules are rendered one top-level statement at a time, so only the source of a single statement is held in memory
+    at once.
+
+    Args:
+        node: Any AST node derived from ast.AST.
+        cache (RenderCache): Passed on to to_source.
+        profile (Profile): Passed on to to_source.
+        max_line_length (int): Passed on to to_source.
+        minify (bool): Passed on to to_source.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source.
+
+    Yields: str: Consecutive chunks of the source code corresponding to the AST.
+    """
+    to_source = (generator if generator is not None else _default_generator).to_source
+    if isinstance(node, ast.Module):
+        for i, child in enumerate(node.body):
+            if i:
+                yield '\n'
+            yield to_source(child, cache=cache, profile=profile, max_line_length=max_line_length, minify=minify)
+    elif node is not None:
+        yield to_source(node, cache=cache, profile=profile, max_line_length=max_line_length, minify=minify)
+
+
+def to_source_to_file(node, file, encoding='utf-8', cache=None, profile=None, max_line_length=None, minify=False,
+                      generator=None):
+    """ Converts an AST node into source code, writing it to a file as it is rendered.
+
+    Args:
+        node: Any AST node derived from ast.AST.
+        file: A text or binary file object open for writing.
+        encoding (str): The encoding used when writing to a binary file.
+        cache (RenderCache): Passed on to to_source.
+        profile (Profile): Passed on to to_source.
+        max_line_length (int): Passed on to to_source.
+        minify (bool): Passed on to to_source.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source.
+
+    Returns: int: The number of characters (or bytes, for binary files) written.
+    """
+    return _write(to_source_stream(node, cache, profile, max_line_length, minify, generator), file, encoding)
+
+
+def to_source_into(node, buffer, offset=0, encoding='utf-8', cache=None, profile=None, max_line_length=None,
+                   minify=False, generator=None):
+    """ Converts an AST node into source code, encoding it straight into a buffer.
+
+    The source is encoded a top-level statement at a time, so neither the whole source nor its encoding is ever held
+    in memory apart from the buffer. A bytearray grows as needed but never shrinks, so reusing it for many calls only
+    allocates memory while the sources grow. The memoryview returned has to be released before a bytearray can grow
+    again, so release it (or use it in a with statement) before the next call.
+
+    Args:
+        node: Any AST node derived from ast.AST.
+        buffer: A bytearray, or any other writable buffer (like an mmap), which must then be large enough to hold the
+            encoded source.
+        offset (int): The position in the buffer to write the source at.
+        encoding (str): The encoding of the source.
+        cache (RenderCache): Passed on to to_source.
+        profile (Profile): Passed on to to_source.
+        max_line_length (int): Passed on to to_source.
+        minify (bool): Passed on to to_source.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source.
+
+    Returns: memoryview: A view of the part of the buffer holding the encoded source.
+
+    Raises:
+        ValueError: If the offset is outside the buffer, or a buffer that can't grow is too small to hold the source.
+    """
+    resizable = isinstance(buffer, bytearray)
+    target = buffer if resizable else memoryview(buffer).cast('B')
+    size = len(target)
+    if not 0 <= offset <= size:
+        raise ValueError('offset {} is outside the buffer of {} bytes'.format(offset, size))
+    position = offset
+    for data in _encoded(to_source_stream(node, cache, profile, max_line_length, minify, generator), encoding):
+        end = position + len(data)
+        if end > size and not resizable:
+            raise ValueError('the buffer is too small to hold the source')
+        target[position:end] = data  # Past the end of a bytearray, this appends the rest
+        position = end
+    return memoryview(buffer).cast('B')[offset:position]
+
+
+def _write(chunks, file, encoding):  # Writes chunks of source to a text or binary file, returning the amount written
+    binary = isinstance(file, (io.RawIOBase, io.BufferedIOBase)) or 'b' in getattr(file, 'mode', '')
+    written = 0
+    for chunk in _encoded(chunks, encoding) if binary else chunks:
+        file.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def _encoded(chunks, encoding):  # Encodes chunks of source with a single encoder, so that any BOM is only written once
+    encode = codecs.getincrementalencoder(encoding)().encode
+    for chunk in chunks:
+        yield encode(chunk)
+    yield encode('', final=True)
+
+
+# Matches what changes where lines may end: comments, explicitly joined lines, brackets, line ends and string quotes
+_scanned = re.compile(rb'#[^\r\n]*|\\\r?\n|[][(){}\n]|\'\'\'|"""|\'|"')
+# Maps quotes to patterns matching the rest of the strings they start
+_string_ends = {}
+for _quote in (b"'", b'"'):
+    _string_ends[_quote] = re.compile(rb'[^\\%s\n]*(?:\\.[^\\%s\n]*)*%s' % (_quote, _quote, _quote), re.S)
+    _string_ends[_quote * 3] = re.compile(rb'[^\\%s]*(?:(?:\\.|%s(?!%s%s))[^\\%s]*)*%s%s%s' % ((_quote,) * 8), re.S)
+del _quote
+_continued = re.compile(rb'(?:else|elif|except|finally)\b|[ \t\f\r\n#]')  # Lines that can't start a statement
+
+
+def _top_level(data):
+    # Yields the line number and tree of each run of top-level statements in the encoded source, parsing them
+    # separately. Lines that seem to start a new statement (scanning for brackets and strings) end a run if the lines
+    # before them parse, which also keeps the runs right where the scan is wrong; the rest of the source is then parsed
+    # at once
+    size = len(data)
+    lines = iter(bytes(data[:1024]).splitlines(True))
+    encoding = tokenize.detect_encoding(lambda: next(lines, b''))[0]
+    scan, ends, continued = _scanned.search, _string_ends, _continued.match
+    start = pos = depth = 0
+    lineno = 1
+    while True:
+        match = scan(data, pos)
+        if match is None:
+            break
+        token = match.group()
+        pos = match.end()
+        if token == b'\n':
+            if depth or pos >= size or continued(data, pos):
+                continue
+            chunk = data[start:pos]
+            try:
+                tree = ast.parse(chunk.decode(encoding))
+            except SyntaxError:
+                continue
+            if tree.body:
+                yield lineno, tree
+            lineno += chunk.count(b'\n')
+            start = pos
+        elif token in b'([{':
+            depth += 1
+        elif token in b')]}':
+            depth -= 1
+        elif token[0] == 35 or token[0] == 92:  # Comments and explicitly joined lines
+            continue
+        else:
+            match = ends[token].match(data, pos)
+            if match is None:  # Unterminated
+                break
+            pos = match.end()
+    chunk = data[start:]
+    try:
+        tree = ast.parse(chunk.decode(encoding))
+    except SyntaxError as e:
+        if e.lineno is not None:
+            e.lineno += lineno - 1
+        raise
+    yield lineno, tree
+
+
+def transform_stream(source, transformers=(), cache=None, profile=None, max_line_length=None, minify=False,
+                     generator=None):
+    """ Parses Python source, transforms it and converts it back into source code, one top-level statement at a time.
+
+    Only the source of a few top-level statements and their trees are held in memory at once, so files of any size can
+    be processed. Files are memory-mapped, and split into top-level statements without tokenizing them.
+
+    Each transformer visits a Module holding a single top-level statement at a time, in order, and may keep whatever
+    it needs from earlier statements (like imports) in its own attributes. It may replace or remove the statement, or
+    return the Module with any number of statements in its body instead.
+
+    Args:
+        source: The path of a file to read, or the encoded source itself, as bytes or any other buffer, like an mmap.
+        transformers: A sequence of ast.NodeTransformer instances (or anything else with a visit method), applied in
+            order.
+        cache (RenderCache): Passed on to to_source.
+        profile (Profile): Passed on to to_source.
+        max_line_length (int): Passed on to to_source.
+        minify (bool): Passed on to to_source.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source.
+
+    Yields: str: Consecutive chunks of the source code of the transformed statements.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:  # Empty files can't be mapped
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield from transform_stream(data, transformers, cache, profile, max_line_length, minify, generator)
+        return
+    to_source = (generator if generator is not None else _default_generator).to_source
+    first = True
+    for lineno, tree in _top_level(source):
+        for statement in tree.body:
+            module = ast.Module(body=[statement], type_ignores=[])
+            if transformers and lineno > 1:  # Keep line numbers the same as in the whole source
+                ast.increment_lineno(module, lineno - 1)
+            for transformer in transformers:
+                module = transformer.visit(module)
+                if module is None:
+                    break
+            for child in module.body if module is not None else ():
+                if not first:
+                    yield '\n'
+                first = False
+                yield to_source(child, cache=cache, profile=profile, max_line_length=max_line_length, minify=minify)
+
+
+def transform_file(source, file, transformers=(), encoding='utf-8', cache=None, profile=None, max_line_length=None,
+                   minify=False, generator=None):
+    """ Parses Python source, transforms it and writes it back as source code to a file, one statement at a time.
+
+    Args:
+        source: The path of a file to read, or the encoded source itself, as bytes or any other buffer.
+        file: A text or binary file object open for writing.
+        transformers: Passed on to transform_stream.
+        encoding (str): The encoding used when writing to a binary file.
+        cache (RenderCache): Passed on to to_source.
+        profile (Profile): Passed on to to_source.
+        max_line_length (int): Passed on to to_source.
+        minify (bool): Passed on to to_source.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source.
+
+    Returns: int: The number of characters (or bytes, for binary files) written.
+    """
+    return _write(transform_stream(source, transformers, cache, profile, max_line_length, minify, generator), file,
+                  encoding)
+
+
+_slice_size = 32  # The number of statements a block statement holds before it's split into slices
+
+
+def _slices(node, cache=None, profile=None, max_line_length=None, minify=False, generator=None):
+    # Yields the source of a node in chunks like to_source_stream, but also splits block statements holding many
+    # statements into the statements themselves and the rest of the block statement, rendered with hole markers (like
+    # those of templates) in place of its blocks. The line of each marker gives the indentation of the block.
+    # Minified and wrapped statements depend on what surrounds them, so they're only split at the top level
+    to_source = (generator if generator is not None else _default_generator).to_source
+    options = dict(cache=cache, profile=profile, max_line_length=max_line_length, minify=minify)
+    if not isinstance(node, ast.Module):
+        if node is not None:
+            yield to_source(node, **options)
+        return
+    split = not minify and max_line_length is None
+    # Holds text to write, and statements along with their indentation and the text to write before them
+    stack = [(statement, '', '\n' if i else '') for i, statement in reversed(list(enumerate(node.body)))]
+    while stack:
+        item = stack.pop()
+        if item.__class__ is str:
+            yield item
+            continue
+        statement, indent, lead = item
+        blocks = [field for field in statement._fields if _is_block(getattr(statement, field, None)) and
+                  isinstance(getattr(statement, field)[0], ast.stmt)] if split else ()
+        if statement.__class__ is ast.If and 'orelse' in blocks and len(statement.orelse) == 1 and \
+                isinstance(statement.orelse[0], ast.If):  # Rendered in place as elif
+            blocks.remove('orelse')
+        if sum(len(getattr(statement, field)) for field in blocks) < _slice_size:
+            source = to_source(statement, **options)
+            yield lead + (source.replace('\n', '\n' + indent) if indent else source)
+            continue
+        skeleton = copy.copy(statement)
+        for i, field in enumerate(blocks):
+            setattr(skeleton, field, [ast.Expr(value=ast.Name(id=_HOLE + str(i) + _HOLE_END, ctx=ast.Load()))])
+        parts = _holes.split(to_source(skeleton, **options).replace('\n', '\n' + indent))
+        pending = [lead + parts[0]]
+        for j in range(1, len(parts), 2):
+            block_indent = parts[j-1][parts[j-1].rfind('\n')+1:]
+            pending.extend((child, block_indent, '\n' + block_indent if k else '')
+                           for k, child in enumerate(getattr(statement, blocks[int(parts[j])])))
+            pending.append(parts[j+1])
+        stack.extend(reversed(pending))
+
+
+async def to_source_async(node, writer=None, encoding='utf-8', cache=None, profile=None, max_line_length=None,
+                          minify=False, interval=0.005, generator=None):
+    """ Converts an AST node into source code without blocking the asyncio event loop for long.
+
+    Modules are rendered a statement at a time, splitting block statements that hold many statements into those
+    statements (unless minifying or breaking long lines). Whenever rendering has taken longer than interval seconds
+    since the last pause, it pauses to let other tasks run.
+
+    Args:
+        node: Any AST node derived from ast.AST.
+        writer (asyncio.StreamWriter): If given, the source is written to it as it is rendered, waiting for its buffer
+            to drain at each pause, instead of being returned.
+        encoding (str): The encoding used when writing.
+        cache (RenderCache): Passed on to to_source.
+        profile (Profile): Passed on to to_source.
+        max_line_length (int): Passed on to to_source.
+        minify (bool): Passed on to to_source.
+        interval (float): The longest time in seconds to render for between pauses.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source.
+
+    Returns: str: The source code corresponding to the AST, or int: the number of bytes written, if writer is given.
+    """
+    import asyncio  # Only imported when needed, since it's slow to import
+    chunks, written = [], 0
+    encode = codecs.getincrementalencoder(encoding)().encode  # Writes any BOM only once
+    clock = time.perf_counter
+    start = clock()
+    for chunk in _slices(node, cache, profile, max_line_length, minify, generator):
+        chunks.append(chunk)
+        if clock() - start >= interval:
+            if writer is not None:
+                data = encode(''.join(chunks))
+                del chunks[:]
+                writer.write(data)
+                written += len(data)
+                await writer.drain()  # Waits while the writer's buffer is full
+            await asyncio.sleep(0)
+            start = clock()
+    if writer is None:
+        return ''.join(chunks)
+    data = encode(''.join(chunks), final=True)
+    writer.write(data)
+    await writer.drain()
+    return written + len(data)
+
+
+_statement_fields = {'body', 'orelse', 'finalbody', 'handlers', 'cases'}  # The fields of nodes holding statements
+
+
+class SourceView:
+    """ Renders the source of a tree on demand, one statement or definition at a time.
+
+    Definitions are looked up by their qualified names, in the same form as __qualname__: 'f', 'C.method' or
+    'f.<locals>.inner', wherever they're defined (including inside if and try statements). If a name is defined more
+    than once, it refers to the last definition. Integers and slices look up the statements of the tree's body. The
+    source of each statement is remembered once rendered, so the tree shouldn't be modified while the view is used.
+
+    Args:
+        tree: An AST, usually a Module.
+        generator (SourceGenerator): Renders the statements. By default, the one used by to_source.
+        max_line_length (int): Passed on to to_source.
+    """
+    def __init__(self, tree, generator=None, max_line_length=None):
+        self.tree = tree
+        self.generator = generator if generator is not None else _default_generator
+        self.max_line_length = max_line_length
+        self.body = tree.body if isinstance(tree, (ast.Module, ast.Interactive)) else [tree]
+        self._definitions = None  # Maps qualified names to definitions, once they're first looked up
+        self._sources = {}  # Maps the ids of rendered statements to them and their source
+
+    @property
+    def definitions(self):
+        """ dict: Maps the qualified name of every function and class to its definition. """
+        if self._definitions is None:
+            definitions, fields = {}, {}  # fields holds the fields of each type of statement that may hold statements
+            stack = [(statement, '') for statement in reversed(self.body)]
+            while stack:
+                statement, prefix = stack.pop()
+                cls = statement.__class__
+                if cls is ast.FunctionDef or cls is ast.AsyncFunctionDef or cls is ast.ClassDef:
+                    name = prefix + statement.name
+                    definitions[name] = statement
+                    prefix = name + ('.' if cls is ast.ClassDef else '.<locals>.')
+                names = fields.get(cls)
+                if names is None:
+                    names = fields[cls] = [field for field in reversed(cls._fields) if field in _statement_fields]
+                for field in names:
+                    stack.extend((child, prefix) for child in reversed(getattr(statement, field, None) or ()))
+            self._definitions = definitions
+        return self._definitions
+
+    def source(self, node):
+        """ Returns the source of a statement in the tree, rendering it if it hasn't been already.
+
+        Args:
+            node: The statement.
+
+        Returns: str: The source of the statement, starting at no indentation.
+        """
+        entry = self._sources.get(id(node))
+        if entry is None or entry[0] is not node:
+            entry = self._sources[id(node)] = (node, self.generator.to_source(
+                node, max_line_length=self.max_line_length))
+        return entry[1]
+
+    def __len__(self): return len(self.body)
+
+    def __contains__(self, name): return name in self.definitions
+
+    def __getitem__(self, key):
+        """ Returns the source of a definition by its qualified name, or of a statement (or slice of them) of the body.
+        """
+        if key.__class__ is str:
+            return self.source(self.definitions[key])
+        elif isinstance(key, slice):
+            return '\n'.join(map(self.source, self.body[key]))
+        return self.source(self.body[key])
+
+    def __str__(self): return self[:]
+
+
+def patch_source(source, tree, original=None):
+    """ Converts a modified AST back into source code, copying unchanged statements from the source it was parsed from.
+
+    Statements that are unchanged (and at the same indentation) are copied verbatim, along with any comments and blank
+    lines around them, while new or modified statements are rendered as usual. On Python versions before 3.8, where
+    nodes don't record where they end, the whole tree is rendered.
+
+    Unless the original tree is given, the source is parsed again, which takes about as long as rendering the whole
+    tree, and every statement is compared with the original, which takes about twice as long: an unchanged module is
+    written back three to four times slower than to_source renders it. Statements shared by the two trees aren't
+    compared, so building the modified tree from the statements of the original one (rather than modifying a copy of
+    it) makes patching faster than rendering.
+
+    Args:
+        source (str): The source code the tree was originally parsed from.
+        tree: The modified AST.
+        original: The AST parsed from the source, if it's still at hand. It must not have been modified since.
+
+    Returns: str: A string containing the source code corresponding to the AST.
+    """
+    patcher = _SourcePatcher(source, original)
+    result = to_source(tree, cache=patcher)
+    body = patcher.module.body
+    if not body and isinstance(tree, ast.Module) and not tree.body:  # Only comments and blank lines, left unchanged
+        return source
+    if body and isinstance(tree, ast.Module):
+        # Keep whatever came before the first statement and after the last, if they were copied
+        if patcher.first is body[0]:
+            decorators = getattr(body[0], 'decorator_list', None)
+            start_line = decorators[0].lineno if decorators else body[0].lineno
+            result = '\n'.join(patcher.text(1, 0, start_line, body[0].col_offset)) + result
+        if patcher.last is body[-1] and patcher.end == len(patcher.output):
+            result += '\n'.join(patcher.text(patcher.stop[0], patcher.stop[1], len(patcher.lines), None))
+    newline = _newline.search(source)
+    return result.replace('\n', newline.group()) if newline and newline.group() != '\n' else result
+
+
+# Templates are rendered with each hole replaced by _HOLE, the number of the hole and _HOLE_END, which split the source
+# into the fragments between holes
+_HOLE, _HOLE_END = '\x11', '\x12'
+_holes = re.compile('\x11(\\d+)\x12')
+
+
+def _hole_context(node, field):
+    # The parent operator and side of it that a child of a node in a field is rendered on, or True for whole statements
+    cls = node.__class__
+    if cls is ast.BinOp:
+        return node.op.__class__, -1 if field == 'left' else 1
+    elif cls is ast.UnaryOp or cls is ast.BoolOp:
+        return node.op.__class__, 0
+    elif cls is ast.Compare:
+        return ast.Compare, 0
+    elif cls is ast.Attribute or cls is ast.Subscript or cls is ast.Call:
+        return (cls, 0) if field in ('value', 'func') else False
+    return cls is ast.Expr
+
+
+class Template:
+    """ A tree with holes, rendered once so that its source can be produced with the holes filled in by only rendering
+    what fills them.
+
+    A hole is a name: every Name node in the tree with that name is a hole, and so is any other identifier equal to
+    it, like the name of a function, argument, attribute or keyword. The source of each substitution is the same as
+    that of the tree with the holes replaced, so operators filling holes are parenthesized where they need to be, and
+    so are constants, like a negative number raised to a power. Holes can't be placed inside f-strings.
+
+    Args:
+        node: An AST with holes, or source code to parse into one.
+        holes: The names of the holes.
+        generator (SourceGenerator): Renders the tree and the values filling its holes. By default, the one used by
+            to_source.
+    """
+    def __init__(self, node, holes, generator=None):
+        self.holes = frozenset(holes)
+        self.generator = generator if generator is not None else _default_generator
+        # The copy of the tree is rendered with the holes replaced by markers, numbered in the order they're found
+        tree = load_tree(dump_tree(ast.parse(node) if isinstance(node, str) else node))  # Copies without recursion
+        found, stack = [], [(tree, False)]
+        while stack:
+            node, context = stack.pop()
+            if node.__class__ is ast.Name and node.id in self.holes:
+                found.append((node.id, context))
+                node.id = _HOLE + str(len(found) - 1) + _HOLE_END
+                continue
+            for field, value in ast.iter_fields(node):
+                if value.__class__ is str and value in self.holes and field not in ('s', 'value', 'kind'):
+                    found.append((value, False))
+                    setattr(node, field, _HOLE + str(len(found) - 1) + _HOLE_END)
+                elif value.__class__ is list:
+                    for i, item in enumerate(value):
+                        if item.__class__ is str and item in self.holes:  # Like the names of Global statements
+                            found.append((item, False))
+                            value[i] = _HOLE + str(len(found) - 1) + _HOLE_END
+                        elif isinstance(item, ast.AST):
+                            stack.append((item, _hole_context(node, field)))
+                elif isinstance(value, ast.AST):
+                    stack.append((value, _hole_context(node, field)))
+        parts = _holes.split(self.generator.to_source(tree))
+        if len(parts) // 2 != len(found):
+            raise ValueError('holes can\'t be filled in inside f-strings')
+        # Each distinct way a hole is filled in, as its name, parent operator and side, whether it's a whole statement
+        # and the indentation of its line, and which of the parts between the fragments each of them fills
+        self._keys, self._slots, keys = [], [], {}
+        for j in range(1, len(parts), 2):
+            name, context = found[int(parts[j])]
+            line = parts[j-1][parts[j-1].rfind('\n')+1:]
+            key = (name,) + (context if context.__class__ is tuple else (None, 0)) + \
+                (context is True, ' ' * (len(line) - len(line.lstrip(' '))))
+            if key not in keys:
+                keys[key] = len(self._keys)
+                self._keys.append(key)
+            self._slots.append((j, keys[key]))
+            parts[j] = None
+        self._parts = parts
+
+    def _render(self, value, parent_op, descend, statement, indent):  # Renders a value filling a hole
+        if value.__class__ is str:
+            source = value
+        elif statement and value.__class__ is list:
+            source = self.generator.to_source(ast.Module(body=value, type_ignores=[])) if value else 'pass'
+        elif isinstance(value, ast.AST) and value.__class__ is not _Constant:
+            source = self.generator.to_source(value, parent_op, descend)
+        else:  # A constant, rendered as a node so that generators can change how constants are written
+            if _Constant is None:
+                source = '...' if value is Ellipsis else repr(value)
+            else:
+                source = self.generator.to_source(value if value.__class__ is _Constant else _Constant(value=value))
+            # Negative numbers need parentheses wherever a unary minus would, and so do integers with an attribute,
+            # since 1.real would be read as a float
+            if source[:1] == '-' and _parens(ast.USub, parent_op, descend) or \
+                    parent_op is ast.Attribute and source.isdigit():
+                source = '(' + source + ')'
+        return source.replace('\n', '\n' + indent) if indent and '\n' in source else source
+
+    def substitute(self, mapping=None, **values):
+        """ Returns the source code of the tree, with its holes filled in.
+
+        Args:
+            mapping (dict): Maps the names of holes to the values filling them, along with any keyword arguments.
+                Values may be AST nodes, strings inserted as they are (like identifiers), lists of statements filling
+                holes that are whole statements, or any constant.
+
+        Returns: str: The source code.
+        """
+        if mapping is not None:
+            values = dict(mapping, **values)
+        sources = []
+        for key in self._keys:
+            value = values[key[0]]
+            if value.__class__ is not str or key[4] and '\n' in value:
+                value = self._render(value, *key[1:])
+            sources.append(value)
+        parts = self._parts[:]
+        for j, key in self._slots:
+            parts[j] = sources[key]
+        return ''.join(parts)
+
+
+class _DumpedTree(bytes):  # A tree encoded by dump_tree, sent to the workers of to_source_many instead of pickling it
+    pass
+
+
+def _dumped(item):  # Encodes the tree of an item of to_source_many, if it has one
+    node, destination = item if isinstance(item, tuple) else (item, None)
+    if not isinstance(node, ast.AST):
+        return item
+    try:
+        node = _DumpedTree(dump_tree(node))
+    except Exception:  # Left to fail when it is pickled, like any other item that can't be sent
+        return item
+    return node if destination is None else (node, destination)
+
+
+def _convert(item, max_line_length=None, generator=None):
+    # Converts (and writes) one item of to_source_many, returning its source or the error raised
+    try:
+        node, destination = item if isinstance(item, tuple) else (item, None)
+        if not isinstance(node, (ast.AST, str, bytes, os.PathLike)):
+            raise TypeError('expected a path or an AST, not {}'.format(type(node).__name__))
+        if destination is not None and not isinstance(destination, (str, bytes, os.PathLike)):
+            raise TypeError('expected a destination path, not {}'.format(type(destination).__name__))
+        if isinstance(node, _DumpedTree):
+            node = load_tree(node)
+        elif not isinstance(node, ast.AST):
+            with open(node, 'rb') as f:
+                node = ast.parse(f.read(), os.fspath(node))  # Parsing bytes honors encoding declarations
+        source = (generator if generator is not None else _default_generator).to_source(
+            node, max_line_length=max_line_length)
+        if destination is not None:
+            directory = os.path.dirname(destination)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(destination, 'w', encoding='utf-8') as f:
+                f.write(source + '\n' if source else source)  # Files end with a newline
+        return source, None
+    except Exception as e:
+        return None, e
+
+
+def _convert_chunk(chunk, max_line_length=None, generator=None):
+    return [_convert(item, max_line_length, generator) for item in chunk]
+
+
+def to_source_many(items, workers=None, chunksize=None, max_line_length=None, generator=None):
+    """ Converts many files or ASTs into source code in parallel, across a pool of worker processes.
+
+    Each item is the path of a file to parse, an AST, or a (path or AST, destination) pair whose source is also written
+    to the destination path. Paths are str, bytes or os.PathLike objects; anything else is a TypeError. Results are
+    yielded in the same order as the items, as soon as they are ready. An error converting an item is yielded in its
+    place instead of being raised, so the rest of the batch carries on. ASTs are sent to the workers encoded with
+    dump_tree, but passing paths is still faster.
+
+    Args:
+        items: An iterable of paths, ASTs or (path or AST, destination) pairs.
+        workers (int): The number of worker processes, by default the number of CPUs. With 1, items are converted in
+            this process.
+        chunksize (int): The number of items sent to a worker at a time. By default, the items are split into about
+            four chunks per worker, of at most 64 items each.
+        max_line_length (int): Passed on to to_source.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source. It's pickled to be
+            sent to the workers, so it must be an instance of a class defined at the top level of a module.
+
+    Returns: generator: Yields an (item, source, error) tuple for each item, where source is None if error was raised.
+    """
+    items = list(items)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield (item,) + _convert(item, max_line_length, generator)
+        return
+    if chunksize is None:
+        chunksize = max(1, min(64, len(items) // (workers * 4)))
+    chunks = [items[i:i+chunksize] for i in range(0, len(items), chunksize)]
+    with futures.ProcessPoolExecutor(min(workers, len(chunks))) as executor:
+        submitted = [executor.submit(_convert_chunk, list(map(_dumped, chunk)), max_line_length, generator)
+                     for chunk in chunks]
+        for chunk, future in zip(chunks, submitted):
+            try:
+                results = future.result()
+            except Exception as e:  # The chunk couldn't be sent to or back from a worker, or the worker died
+                results = [(None, e)] * len(chunk)
+            for item, (source, error) in zip(chunk, results):
+                yield item, source, error
+
+
+_compared_fields = {}  # Maps classes to the fields compare_ast compares and a getter for them, or False if not AST
+
+
+def _compared(cls):
+    if not issubclass(cls, ast.AST):
+        entry = False
+    else:  # Expression contexts (and positions, for old versions of Python) never differ
+        fields = tuple(f for f in cls._fields if f not in ('lineno', 'col_offset', 'ctx'))
+        getter = operator.attrgetter(*fields) if fields else lambda node: ()
+        if len(fields) == 1:  # attrgetter only returns a tuple for more than one field
+            getter = lambda node, get=getter: (get(node),)
+        entry = (fields, getter, tuple((field,) for field in fields))
+    _compared_fields[cls] = entry
+    return entry
+
+
+def _values(node, entry):  # The values of the compared fields of a node
+    try:
+        return entry[1](node)
+    except AttributeError:  # Nodes built by hand may be missing fields
+        return [getattr(node, field, None) for field in entry[0]]
 
 
 def compare_ast(node1, node2):
@@ -452,18 +2130,773 @@ def compare_ast(node1, node2):
 
     Returns: bool: True if the nodes represent the same AST, false otherwise.
     """
-    if type(node1) is not type(node2):
-        return False
-    if isinstance(node1, ast.AST):
-        for field, child in ast.iter_fields(node1):
-            if field in ['lineno', 'col_offset', 'ctx']:
-                continue
-            if not compare_ast(child, getattr(node2, field)):
+    # The stack holds pairs of sequences of the same length to compare element by element: the values of the fields of
+    # two nodes, or two lists. Subtrees that are the same object are never compared
+    fields_of, compared, values = _compared_fields, _compared, _values
+    stack = [((node1,), (node2,))]
+    push, pop = stack.append, stack.pop
+    while stack:
+        values1, values2 = pop()
+        for value1, value2 in zip(values1, values2):
+            cls = value1.__class__
+            if cls is not value2.__class__:
                 return False
-        return True
-    elif isinstance(node1, list):
-        return all(compare_ast(e1, e2) for e1, e2 in zip(node1, node2))
-    else:
-        return node1 == node2
+            if cls is list:
+                if len(value1) != len(value2):
+                    return False
+                if value1 and value1 is not value2:
+                    push((value1, value2))
+                continue
+            entry = fields_of.get(cls)
+            if entry is None:
+                entry = compared(cls)
+            if entry is False:
+                if value1 != value2:
+                    return False
+            elif value1 is not value2:
+                try:
+                    push((entry[1](value1), entry[1](value2)))
+                except AttributeError:
+                    push((values(value1, entry), values(value2, entry)))
+    return True
+
+
+def find_difference(node1, node2):
+    """ Finds where two ASTs differ, comparing them in the same way as compare_ast.
 
-__all__ = ['to_source', 'compare_ast']
+    The children of each node are compared before any of their descendants, and the first difference found is returned.
+
+    Args:
+        node1: The first node.
+        node2: The second node.
+
+    Returns: tuple: The path of field names and list indices leading from the nodes to where they differ, such as
+        ('body', 0, 'value', 'id'), or None if the nodes represent the same AST.
+    """
+    # Works like compare_ast, but also keeps the path to each pair of sequences and the keys of their elements
+    fields_of, compared, values = _compared_fields, _compared, _values
+    stack = [((node1,), (node2,), ((),), ())]
+    push, pop = stack.append, stack.pop
+    while stack:
+        values1, values2, keys, path = pop()
+        for value1, value2, key in zip(values1, values2, keys):
+            cls = value1.__class__
+            if cls is not value2.__class__:
+                return path + key
+            if cls is list:
+                if len(value1) != len(value2):
+                    return path + key
+                if value1 and value1 is not value2:
+                    push((value1, value2, [(i,) for i in range(len(value1))], path + key))
+                continue
+            entry = fields_of.get(cls)
+            if entry is None:
+                entry = compared(cls)
+            if entry is False:
+                if value1 != value2:
+                    return path + key
+            elif value1 is not value2:
+                push((values(value1, entry), values(value2, entry), entry[2], path + key))
+    return None
+
+
+def _digest64(data):  # A hash of bytes that is the same in every process, unlike hash()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def _value_hash(value, strings):
+    # Hashes a field value that isn't a node or list, along with its type. Numbers hash the same in every process, but
+    # strings, bytes and (before Python 3.12) None and Ellipsis don't, so they are hashed with _digest64 instead
+    cls = value.__class__
+    kind = strings.get(cls)
+    if kind is None:
+        kind = strings[cls] = _digest64(cls.__qualname__.encode('utf-8'))
+    if cls is str or cls is bytes:
+        h = strings.get(value)
+        if h is None:
+            h = strings[value] = hash((kind, _digest64(value.encode('utf-8', 'surrogatepass') if cls is str else value)))
+        return h
+    elif value is None or value is Ellipsis:
+        return kind
+    elif cls is tuple:
+        return hash((kind,) + tuple(_value_hash(item, strings) for item in value))
+    elif cls is frozenset:  # Independent of the order of iteration, which depends on string hashes
+        return hash((kind, sum(_value_hash(item, strings) for item in value) & 0xffffffffffffffff))
+    elif cls in (int, float, complex, bool):
+        return hash((kind, value))
+    return _value_hash(repr(value), strings)
+
+
+def fingerprint(node, memo=None):
+    """ Computes a structural hash of an AST, ignoring contexts (like compare_ast).
+
+    Nodes that compare_ast considers the same have the same fingerprint, so nodes with different fingerprints are
+    definitely different. Fingerprints are computed bottom-up in a single pass over the tree, and are the same in every
+    process and run of the same version of Python.
+
+    Args:
+        node: Any AST node derived from ast.AST, or a list of them.
+        memo (dict): If given, is filled with the fingerprint of every node (and list of nodes) in the tree, keyed by
+            their ids. Nodes already in it aren't hashed again.
+
+    Returns: int: The fingerprint of the node.
+    """
+    if memo is None:
+        memo = {}
+    strings, getters, AST = {}, {}, ast.AST  # strings holds the hashes of types, strings and bytes
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        cls = item.__class__
+        if cls is tuple:  # All children of a node have been hashed
+            item, kind, children = item
+            hashes = [kind]
+            for child in children:
+                if child.__class__ is str:
+                    h = strings.get(child)
+                    hashes.append(h if h is not None else _value_hash(child, strings))
+                elif child.__class__ is list or isinstance(child, AST):
+                    hashes.append(memo[id(child)])
+                else:
+                    hashes.append(_value_hash(child, strings))
+            memo[id(item)] = hash(tuple(hashes))
+            continue
+        if id(item) in memo:
+            continue
+        entry = getters.get(cls)
+        if entry is None:
+            fields = [] if cls is list else [field for field in cls._fields if field != 'ctx']
+            entry = getters[cls] = (_digest64(cls.__qualname__.encode('utf-8')), fields,
+                                    operator.attrgetter(*fields) if len(fields) > 1 else None)
+        kind, fields, getter = entry
+        if cls is list:
+            children = item
+        elif getter is not None:
+            try:
+                children = getter(item)
+            except AttributeError:  # Nodes built by hand may be missing fields
+                children = [getattr(item, field, None) for field in fields]
+        else:
+            children = [getattr(item, field, None) for field in fields]
+        stack.append((item, kind, children))
+        for child in children:
+            if child.__class__ is not str and child is not None and \
+                    (child.__class__ is list or isinstance(child, AST)) and id(child) not in memo:
+                stack.append(child)
+    return memo[id(node)]
+
+
+def _match(a, b):
+    # Matches equal items of two sequences like patience diff: items at the common start and end first, then those
+    # appearing once in each, in the longest run where they're in the same order, and again between each of those.
+    # Returns the pairs of indices matched, in order
+    pairs, stack = [], [(0, len(a), 0, len(b))]
+    while stack:
+        i, i_end, j, j_end = stack.pop()
+        while i < i_end and j < j_end and a[i] == b[j]:
+            pairs.append((i, j))
+            i, j = i + 1, j + 1
+        while i < i_end and j < j_end and a[i_end-1] == b[j_end-1]:
+            i_end, j_end = i_end - 1, j_end - 1
+            pairs.append((i_end, j_end))
+        if i == i_end or j == j_end:
+            continue
+        first, second = {}, {}  # Map items to their index, or -1 if they appear more than once
+        for k in range(i, i_end):
+            first[a[k]] = -1 if a[k] in first else k
+        for k in range(j, j_end):
+            second[b[k]] = -1 if b[k] in second else k
+        unique = [(first[item], k) for item, k in second.items() if k >= 0 and first.get(item, -1) >= 0]
+        if not unique:
+            continue
+        unique.sort(key=operator.itemgetter(1))
+        # The longest run of unique items in the same order in both, by patience sorting. Each item is linked to the
+        # top of the pile before its own when it was placed
+        tails, tops, links = [], [], []
+        for n, (k, _) in enumerate(unique):
+            pile = bisect.bisect_left(tails, k)
+            links.append(tops[pile-1] if pile else -1)
+            if pile == len(tails):
+                tails.append(k)
+                tops.append(n)
+            else:
+                tails[pile], tops[pile] = k, n
+        anchors = []
+        n = tops[-1]
+        while n >= 0:
+            anchors.append(unique[n])
+            n = links[n]
+        anchors.reverse()
+        for k, l in anchors:
+            pairs.append((k, l))
+            stack.append((i, k, j, l))
+            i, j = k + 1, l + 1
+        stack.append((i, i_end, j, j_end))
+    pairs.sort()
+    return pairs
+
+
+def _is_block(value): return value.__class__ is list and bool(value) and isinstance(value[0], _block_types)
+
+
+def _key(node): return node.__class__, getattr(node, 'name', None)  # Statements that are paired up when changed
+
+
+Change = collections.namedtuple('Change', ['kind', 'old_path', 'new_path', 'old', 'new'])
+Change.__doc__ = """ A change between two ASTs found by ast_diff.
+
+Attributes:
+    kind (str): 'insert', 'delete' or 'modify'.
+    old_path (tuple): The path of field names and list indices from the old tree to the node that was deleted or
+        modified (like find_difference), or to where a node was inserted.
+    new_path (tuple): The same path in the new tree.
+    old: The deleted or modified node in the old tree, or None for insertions.
+    new: The inserted or modified node in the new tree, or None for deletions.
+"""
+
+
+def ast_diff(old, new, source=False):
+    """ Finds the statements that were inserted, deleted or modified between two versions of an AST.
+
+    Unchanged statements are matched by their fingerprints, like patience diff matches lines, so that only the
+    statements and blocks that changed are compared further. Changed statements of the same type (and name, for
+    functions and classes) are paired up. Those whose own fields are unchanged, like functions whose bodies changed, are
+    compared statement by statement in turn; otherwise they are modified as a whole.
+
+    Args:
+        old: The old AST.
+        new: The new AST.
+        source (bool): Whether to render the old and new nodes of each change with to_source, instead of returning
+            the nodes themselves.
+
+    Returns: list: The changes, as Change tuples in the order of the statements they change.
+    """
+    old_memo, new_memo = {}, {}
+    fingerprint(old, old_memo)
+    fingerprint(new, new_memo)
+    changes, stack = [], [(old, new, (), ())]
+    while stack:
+        item = stack.pop()
+        if item.__class__ is Change:  # Pushed in order along with the pairs of statements before and after it
+            changes.append(item)
+            continue
+        a, b, a_path, b_path = item
+        if old_memo[id(a)] == new_memo[id(b)]:
+            continue
+        blocks = []
+        if a.__class__ is b.__class__:
+            for field in a._fields:
+                a_value, b_value = getattr(a, field, None), getattr(b, field, None)
+                if _is_block(a_value) or _is_block(b_value):
+                    blocks.append((field, a_value or [], b_value or []))
+                elif not compare_ast(a_value, b_value):
+                    blocks = None
+                    break
+        if not blocks:
+            changes.append(Change('modify', a_path, b_path, a, b))
+            continue
+        pending = []  # Pairs of statements to compare and changes, in order
+        for field, a_block, b_block in blocks:
+            a_hashes, b_hashes = [old_memo[id(node)] for node in a_block], [new_memo[id(node)] for node in b_block]
+            i = j = 0
+            for k, l in _match(a_hashes, b_hashes) + [(len(a_block), len(b_block))]:
+                # Pair up the statements between matches by their type and name, in order. The deleted statements come
+                # first, then the inserted and paired statements in their new order
+                inserted, paired = collections.defaultdict(collections.deque), {}
+                for n in range(j, l):
+                    inserted[_key(b_block[n])].append(n)
+                for n in range(i, k):
+                    candidates = inserted.get(_key(a_block[n]))
+                    if candidates:
+                        paired[candidates.popleft()] = n
+                    else:
+                        pending.append(Change('delete', a_path + (field, n), b_path + (field, j), a_block[n], None))
+                for n in range(j, l):
+                    m = paired.get(n)
+                    if m is None:
+                        pending.append(Change('insert', a_path + (field, i), b_path + (field, n), None, b_block[n]))
+                    else:
+                        pending.append((a_block[m], b_block[n], a_path + (field, m), b_path + (field, n)))
+                i, j = k + 1, l + 1
+        stack.extend(reversed(pending))
+    if source:
+        changes = [change._replace(old=to_source(change.old), new=to_source(change.new)) for change in changes]
+    return changes
+
+
+# dump_tree writes a header, a table of the types of node in the tree, their fields and attributes, and the distinct
+# strings and constants in it, then an array of codes and an array of the values of attributes. The codes are in
+# postorder, so that load_tree can build each node from the values on top of a stack: codes >= 0 build a node of that
+# type from the values of its fields, -1 pushes None, other odd codes push the constant numbered (-3 - code) // 2 and
+# even codes pop (-2 - code) // 2 values into a list. Arrays are of little-endian 16-bit integers, or 32-bit if their
+# values need it
+_tree_header = struct.Struct('<4sIIII')  # Magic, flags, size of the table, number of codes and of attribute values
+_tree_magic = b'XYT\x01'
+_NONE = -1
+_UNSET, _WIDE_CODES, _WIDE_ATTRIBUTES = 1, 2, 4  # Flags: whether any attribute is None or not set, and array sizes
+_unset = object()  # Stands in for attributes that aren't set
+
+
+def _tree_getters(cls):  # Returns functions getting a tuple of the fields and of the attributes of a type of node
+    getters = []
+    for names in (cls._fields, cls._attributes):
+        names = tuple(names)
+        if not names:
+            getters.append(None)
+        elif len(names) == 1:  # attrgetter only returns a tuple for more than one name
+            getters.append(lambda node, get=operator.attrgetter(names[0]): (get(node),))
+        else:
+            getters.append(operator.attrgetter(*names))
+    return getters
+
+
+def _narrow(values):  # Whether all values fit in a 16-bit array, along with two values reserved for None and unset
+    return not values or min(values) > -2**15 + 1 and max(values) < 2**15
+
+
+_gc_lock, _gc_paused = threading.Lock(), [0, False]  # Number of calls pausing garbage collection, and whether it was on
+
+
+def _pause_gc():
+    with _gc_lock:
+        if not _gc_paused[0]:
+            _gc_paused[1] = gc.isenabled()
+            gc.disable()
+        _gc_paused[0] += 1
+
+
+def _resume_gc():
+    with _gc_lock:
+        _gc_paused[0] -= 1
+        if not _gc_paused[0] and _gc_paused[1]:
+            gc.enable()
+
+
+def dump_tree(node):
+    """ Encodes an AST as compact bytes, which load_tree decodes back into an equal tree.
+
+    Each type of node, field name, string and constant is stored once, and the structure of the tree and the locations
+    of its nodes are arrays of integers, so the encoding is much smaller and faster to load than a pickled tree. Use it
+    to send trees to other processes, or to store them.
+
+    Args:
+        node: Any AST node derived from ast.AST.
+
+    Returns: bytes: The encoded tree.
+    """
+    codes, positions, table, pool = [], [], [], []
+    types, constants = {}, {}  # Map AST classes to their code and getters, and constants to their codes
+    emit, extend = codes.append, positions.extend
+    # Nodes are written in preorder with the values of their fields in reverse, and both arrays are reversed at the end.
+    # Reversing the attributes of each node too would take longer than storing their names in reverse
+    stack = [node]
+    push, pop = stack.append, stack.pop
+    while stack:
+        value = pop()
+        cls = value.__class__
+        if cls is str:
+            code = constants.get(value)
+            if code is None:
+                code = constants[value] = -3 - 2 * len(pool)
+                pool.append(value)
+            emit(code)
+            continue
+        entry = types.get(cls)
+        if entry.__class__ is int:  # Nodes without fields or attributes, like contexts and operators
+            emit(entry)
+        elif entry is not None:
+            code, fields, attributes = entry
+            emit(code)
+            if attributes is not None:
+                try:
+                    extend(attributes(value))
+                except AttributeError:  # Nodes built by hand may be missing attributes
+                    extend([getattr(value, name, _unset) for name in cls._attributes])
+            if fields is not None:
+                try:
+                    stack.extend(fields(value))
+                except AttributeError:  # Or fields
+                    stack.extend([getattr(value, name, None) for name in cls._fields])
+        elif cls is list:
+            emit(-2 - 2 * len(value))
+            stack.extend(value)
+        elif value is None:
+            emit(_NONE)
+        elif isinstance(value, ast.AST):
+            types[cls] = len(table) if not cls._fields and not cls._attributes else \
+                (len(table),) + tuple(_tree_getters(cls))
+            table.append((cls.__name__, tuple(cls._fields), tuple(cls._attributes)[::-1]))
+            push(value)
+        else:
+            key = (cls, repr(value))  # Unlike values, reprs tell apart 1, 1.0 and True, or 0.0 and -0.0
+            code = constants.get(key)
+            if code is None:
+                code = constants[key] = -3 - 2 * len(pool)
+                pool.append(value)
+            emit(code)
+    codes.reverse()
+    positions.reverse()
+    flags = 0
+    try:
+        codes = array.array('h', codes)
+    except OverflowError:
+        codes, flags = array.array('i', codes), _WIDE_CODES
+    try:
+        positions = array.array('h', positions)
+    except (OverflowError, TypeError):  # Wider values, or attributes that are None or unset
+        values = [value for value in positions if value is not None and value is not _unset]
+        if len(values) != len(positions):
+            flags |= _UNSET
+        if not _narrow(values):
+            flags |= _WIDE_ATTRIBUTES
+        if flags & _UNSET:
+            none = -2**31 if flags & _WIDE_ATTRIBUTES else -2**15
+            positions = [none if value is None else none + 1 if value is _unset else value for value in positions]
+        positions = array.array('i' if flags & _WIDE_ATTRIBUTES else 'h', positions)
+    table = marshal.dumps((table, pool))
+    table += bytes(-len(table) % 4)  # Keeps the arrays aligned
+    if sys.byteorder == 'big':
+        codes.byteswap()
+        positions.byteswap()
+    header = _tree_header.pack(_tree_magic, flags, len(table), len(codes), len(positions))
+    codes = codes.tobytes()
+    return b''.join([header, table, codes, bytes(-len(codes) % 4), positions.tobytes()])
+
+
+def load_tree(data):
+    """ Decodes an AST encoded by dump_tree, raising ValueError if the data wasn't encoded by it or is truncated.
+
+    Args:
+        data: The encoded tree, as bytes or any other buffer, like a memoryview or mmap. Its contents are read in place,
+            without copying them first.
+
+    Returns: The decoded AST.
+    """
+    view = memoryview(data).cast('B')
+    if view.nbytes < _tree_header.size or view[:4] != _tree_magic:
+        raise ValueError('data was not encoded by dump_tree')
+    magic, flags, size, length, count = _tree_header.unpack_from(view)
+    start = _tree_header.size
+    sizes = [(4 if wide else 2, n) for wide, n in ((flags & _WIDE_CODES, length), (flags & _WIDE_ATTRIBUTES, count))]
+    if view.nbytes < start + size + sum(itemsize*n + (-itemsize*n % 4) for itemsize, n in sizes):
+        raise ValueError('data is truncated')
+    try:
+        table, pool = marshal.loads(view[start:start+size])
+    except (EOFError, ValueError, TypeError):  # Raised by marshal for data it didn't write
+        raise ValueError('data was not encoded by dump_tree') from None
+    start += size
+    arrays = []
+    for itemsize, n in sizes:
+        wide = itemsize == 4
+        values = view[start:start+itemsize*n].cast('i' if wide else 'h')
+        if sys.byteorder == 'big':
+            values = array.array('i' if wide else 'h', values)
+            values.byteswap()
+        arrays.append(values.tolist())
+        start += itemsize*n + (-itemsize*n % 4)
+    codes, positions = arrays
+    types, new = [], ast.AST.__new__
+    for name, fields, attributes in table:
+        cls = getattr(ast, name, None)
+        if not isinstance(cls, type) or not issubclass(cls, ast.AST):
+            raise ValueError('unknown type of node {!r}'.format(name))
+        # Nodes without fields or attributes, like contexts and operators, are shared as they are by ast.parse
+        types.append((cls, tuple(fields) + tuple(attributes), len(fields), attributes, len(attributes),
+                      None if fields or attributes else new(cls)))
+    none = -2**31 if flags & _WIDE_ATTRIBUTES else -2**15
+    stack, i = [], 0
+    push = stack.append
+    _pause_gc()  # Building a tree is much faster without collections triggered by every few hundred nodes
+    try:
+        for code in codes:
+            if code >= 0:
+                cls, names, n, attributes, m, shared = types[code]
+                if shared is not None:
+                    push(shared)
+                    continue
+                if n:
+                    values = stack[-n:]
+                    del stack[-n:]
+                    if m:
+                        values += positions[i:i+m]
+                        i += m
+                else:
+                    values = positions[i:i+m]
+                    i += m
+                node = new(cls)
+                node.__dict__.update(zip(names, values))
+                if m and flags & _UNSET:
+                    values = node.__dict__
+                    for name in attributes:
+                        if values[name] == none:
+                            values[name] = None
+                        elif values[name] == none + 1:
+                            del values[name]
+                push(node)
+            elif code == _NONE:
+                push(None)
+            elif code & 1:
+                push(pool[(-3 - code) >> 1])
+            elif code == -2:
+                push([])
+            else:
+                n = (-2 - code) >> 1
+                value = stack[-n:]
+                del stack[-n:]
+                push(value)
+    finally:
+        _resume_gc()
+    return stack[0]
+
+
+def _mode(node):  # The mode to compile the source of a node in
+    return 'eval' if isinstance(node, (ast.Expression, ast.expr)) else \
+        'single' if isinstance(node, ast.Interactive) else 'exec'
+
+
+class CodeCache:
+    """ Stores the code compiled from the source of ASTs in a directory, so that identical trees are only compiled
+    once, across processes and runs.
+
+    Code is keyed by a SHA-256 hash of its source, the filename, mode and optimization level it was compiled with, and
+    the version of Python, and stored with marshal like the .pyc files in __pycache__. Rendering a tree is cheaper than
+    compiling it (and than computing its fingerprint), and hashing the source means different trees can never share
+    code. Each entry is written to a temporary file and then renamed into place, so any number of threads and processes
+    can share a directory. Only share directories that you would trust to import .pyc files from.
+
+    Args:
+        directory (str): The directory to store code in, created if needed.
+        maxsize (int): The maximum total size of the stored code in bytes. The least recently used code is removed
+            once it is exceeded, until three quarters of it are left.
+    """
+    suffix = '.' + sys.implementation.cache_tag + '.xyc'
+
+    def __init__(self, directory, maxsize=64*1024*1024):
+        self.directory, self.maxsize = directory, maxsize
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None  # The total size of the stored code, as of the last time it was counted
+
+    def _entries(self):  # The modification time, size and path of each stored file of code
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(self.suffix):
+                        try:
+                            stat = entry.stat()
+                        except OSError:  # Removed by another process
+                            continue
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def __len__(self): return len(self._entries())
+
+    def clear(self):
+        """ Removes all stored code. """
+        with self._lock:
+            for mtime, size, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
+
+    def compile(self, node, filename='<unknown>', mode=None, optimize=-1, generator=None):
+        """ Returns the code compiled from the source of an AST, compiling it only if it isn't stored.
+
+        Args: Same as to_code.
+
+        Returns: code: The compiled code.
+        """
+        mode = mode or _mode(node)
+        optimize = sys.flags.optimize if optimize == -1 else optimize
+        source = (generator if generator is not None else _default_generator).to_source(node)
+        key = hashlib.sha256(repr((filename, mode, optimize)).encode('utf-8'))
+        key.update(source.encode('utf-8', 'surrogatepass'))
+        path = os.path.join(self.directory, key.hexdigest()[:32] + self.suffix)
+        code = self._load(path)
+        with self._lock:
+            if code is not None:
+                self.hits += 1
+                return code
+            self.misses += 1
+        code = compile(source, filename, mode, dont_inherit=True, optimize=optimize)
+        try:
+            self._store(path, importlib.util.MAGIC_NUMBER + marshal.dumps(code))
+        except OSError:  # Code that can't be stored is still returned
+            pass
+        return code
+
+    def _load(self, path):  # Returns stored code, or None if it isn't stored or can't be read
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Marks it as recently used
+        except OSError:
+            return None
+        magic = importlib.util.MAGIC_NUMBER
+        if data[:len(magic)] != magic:
+            return None
+        try:
+            return marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):  # Truncated or corrupted
+            return None
+
+    def _store(self, path, data):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for mtime, size, path in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.maxsize:
+                self._evict()
+
+    def _evict(self):
+        # Removes the least recently used code until three quarters of maxsize are left. Other processes may have
+        # stored or removed code since the size was last counted, so it is counted again first
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in entries:
+            if size <= self.maxsize * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+        self._size = size
+
+
+def to_code(node, filename='<unknown>', mode=None, optimize=-1, cache=None, generator=None):
+    """ Converts an AST node into source code, and compiles it.
+
+    Compiling the source rather than the tree itself gives the code locations in the source, which tracebacks and
+    debuggers can show.
+
+    Args:
+        node: Any AST node derived from ast.AST.
+        filename (str): The filename the code is compiled with.
+        mode (str): 'exec', 'eval' or 'single', as for compile. By default 'eval' for Expression nodes and
+            expressions, 'single' for Interactive nodes and 'exec' otherwise.
+        optimize (int): The optimization level, as for compile.
+        cache (CodeCache): If given, reuses the code compiled from the same source, even in another process.
+        generator (SourceGenerator): Renders the source. By default, the one used by to_source.
+
+    Returns: code: The compiled code.
+    """
+    if cache is not None:
+        return cache.compile(node, filename, mode, optimize, generator)
+    source = (generator if generator is not None else _default_generator).to_source(node)
+    return compile(source, filename, mode or _mode(node), dont_inherit=True, optimize=optimize)
+
+
+def _python_files(path):  # Yields the Python files in a directory tree, or the path itself if it isn't a directory
+    if not os.path.isdir(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.py'):
+                yield os.path.join(root, name)
+
+
+def _digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _up_to_date(path, stat, destination, entry):
+    # Whether a file can be skipped, because its destination is newer or it is unchanged since it was last converted
+    if destination is not None and destination != path:
+        if not os.path.exists(destination):
+            return False
+        if os.stat(destination).st_mtime_ns >= stat.st_mtime_ns:
+            return True
+    if entry is None or entry[1] != stat.st_size:
+        return False
+    return entry[0] == stat.st_mtime_ns or entry[2] == _digest(path)  # Files that were only touched are unchanged
+
+
+def main(argv=None):
+    """ Converts the Python files in directory trees to ASTs and back into source code, from the command line.
+
+    Files that aren't written anywhere are printed to stdout, each after a "# <path>" line. A summary is printed to
+    stderr, whose throughput only counts the files that were converted.
+
+    Args:
+        argv (list): The command line arguments, by default sys.argv[1:].
+
+    Returns: int: The exit status, which is 1 if any file failed to convert.
+    """
+    parser = argparse.ArgumentParser(prog='xylem', description='Convert Python files to ASTs and back into source code.')
+    parser.add_argument('paths', nargs='+', help='files, or directories to search for .py files')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-o', '--output', metavar='DIR', help='write converted files under DIR, mirroring their paths')
+    group.add_argument('-i', '--in-place', action='store_true', help='overwrite files with their converted source')
+    parser.add_argument('-j', '--workers', type=int, metavar='N', help='number of worker processes (default: CPUs)')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='record converted files in FILE, and skip files unchanged since they were recorded')
+    parser.add_argument('-l', '--max-line-length', type=int, metavar='N',
+                        help='break long expressions across lines to keep them within N characters')
+    parser.add_argument('-f', '--force', action='store_true', help="convert files even if they're up to date")
+    args = parser.parse_args(argv)
+    cache = {}
+    if args.cache and os.path.exists(args.cache):
+        with open(args.cache) as f:
+            cache = json.load(f)
+    items, sizes, skipped = [], {}, 0
+    for path in args.paths:
+        for file in _python_files(path):
+            stat = os.stat(file)
+            destination = file if args.in_place else None
+            if args.output:
+                destination = os.path.join(args.output, os.path.relpath(file, path) if file != path else
+                                           os.path.basename(file))
+            if not args.force and _up_to_date(file, stat, destination, cache.get(os.path.abspath(file))):
+                skipped += 1
+                continue
+            items.append(file if destination is None else (file, destination))
+            sizes[file] = stat.st_size
+    start, converted, size = time.perf_counter(), 0, 0
+    for item, source, error in to_source_many(items, args.workers, max_line_length=args.max_line_length):
+        path = item[0] if isinstance(item, tuple) else item
+        if error is not None:
+            print('{}: {}: {}'.format(path, error.__class__.__name__, error), file=sys.stderr)
+            continue
+        converted, size = converted + 1, size + sizes[path]  # Throughput only counts the files that were converted
+        if not isinstance(item, tuple):
+            print('# {}'.format(path))  # Tells apart the sources of several files
+            print(source)
+        if args.cache:
+            stat = os.stat(path)
+            cache[os.path.abspath(path)] = [stat.st_mtime_ns, stat.st_size, _digest(path)]
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    if args.cache:
+        with open(args.cache, 'w') as f:
+            json.dump(cache, f)
+    failed = len(items) - converted
+    print('{} converted, {} skipped, {} failed in {:.2f}s ({:.1f} files/s, {:.0f} bytes/s)'.format(
+        converted, skipped, failed, elapsed, converted / elapsed, size / elapsed), file=sys.stderr)
+    return 1 if failed else 0
+
+
+__all__ = ['to_source', 'to_source_stream', 'to_source_to_file', 'to_source_async', 'to_source_into',
+           'to_source_many', 'to_code', 'transform_stream', 'transform_file', 'SourceGenerator', 'Profile', 'SourceMap',
+           'SourceView', 'RenderCache', 'CodeCache', 'patch_source', 'compare_ast', 'find_difference', 'fingerprint',
+           'ast_diff', 'Change', 'dump_tree', 'load_tree', 'Template']
+
+if __name__ == '__main__':
+    sys.exit(main())